@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""Micro benchmarks for the server's data sources.
+
+    ./benchmark.py <benchmark> [options]
+
+Run without arguments to list the available benchmarks.
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import tracemalloc
+from contextlib import redirect_stdout
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from tornado import gen, httpclient, httpserver, httputil, ioloop, testing
+
+import server
+
+
+def _measure(fn, args):
+    start = time.time()
+    for a in args:
+        fn(a)
+    return (time.time() - start) / len(args)
+
+
+def jmdict_entries(count=2000):
+    """Per-entry latency of the XML decoder versus the compiled store."""
+    jmdict_e = server.JMdict_e()
+    entities = '|'.join(map(server.re.escape, jmdict_e.entities)).encode('utf-8')
+    entity_pattern = server.re.compile(b'&(' + entities + b');')
+
+    ids = list(range(len(jmdict_e.entry_pos)))
+    random.shuffle(ids)
+    ids = ids[:int(count)]
+
+    dictfile = server.MappedFile('data/JMdict_e')
+
+    def decode(e):
+        entry = dictfile.read(jmdict_e.entry_pos[e], jmdict_e.entry_len[e])
+        return server.JMdict_e._decode_entry(
+            bytes(entry), jmdict_e.entities, entity_pattern)
+
+    xml = _measure(decode, ids)
+    store = _measure(jmdict_e._entry, ids)
+
+    print('{} entries'.format(len(ids)))
+    print('    xml:   {:8.1f} us/entry'.format(xml * 1e6))
+    print('    store: {:8.1f} us/entry'.format(store * 1e6))
+    print('    speedup: {:.1f}x'.format(xml / store))
+
+
+def dictionary(count=20000):
+    """Memory and lookup latency of the JMdict_e headword trie."""
+    jmdict_e = server.JMdict_e()
+    d = jmdict_e.dictionary
+    keys = list(d.keys)
+
+    sections = ['keys', 'key_offsets', 'postings', 'values'] + [
+        'trie_' + name for name in server.Trie.SECTIONS]
+    size = sum(jmdict_e.index[name].nbytes for name in sections)
+
+    # the previous representation, a sorted list of (key, [positions])
+    tracemalloc.start()
+    legacy = [(k, [(1 << 20 | j, 1 << 10 | j)
+            for j in range(d.postings[i], d.postings[i + 1])])
+        for i, k in enumerate(keys)]
+    legacy_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del legacy
+
+    queries = [random.choice(keys) for _ in range(int(count))]
+    queries = ([q[:max(1, len(q) // 2)] for q in queries[:len(queries) // 2]] +
+        [q + '\u3093' for q in queries[len(queries) // 2:]])
+
+    print('{} headwords, {} trie nodes'.format(len(keys), len(d.trie.labels)))
+    print('    mapped index: {:8.2f} MB'.format(size / 1e6))
+    print('    sorted list:  {:8.2f} MB'.format(legacy_size / 1e6))
+    print('    get:          {:8.1f} us/query'.format(
+        _measure(d.get, queries) * 1e6))
+    print('    get limit=20: {:8.1f} us/query'.format(
+        _measure(lambda q: d.get(q, 20), queries) * 1e6))
+
+
+def mecab_backends(repeat=20):
+    """Tokens per second of the subprocess and in-process MeCab backends."""
+    with open('fixtures/corpus.txt', 'rb') as f:
+        lines = f.read().decode('utf-8').splitlines()
+
+    # measure analysis, not the cache of analyzed lines
+    server.Config.config['mecab_cache_size'] = '0'
+    for backend in ('subprocess', 'binding'):
+        server.Config.config['mecab_backend'] = backend
+        mecab = server.Mecab()
+        if mecab.backend != backend:
+            print('{:10} unavailable'.format(backend))
+            continue
+        # warm up the dictionary pages
+        [f.result() for f in mecab.analyze_batch(lines)]
+
+        tokens = 0
+        start = time.time()
+        for _ in range(int(repeat)):
+            tokens += sum(len(f.result()) for f in mecab.analyze_batch(lines))
+        elapsed = time.time() - start
+        print('{:10} {:6} workers {:10.0f} tokens/s'.format(
+            backend, len(mecab.workers), tokens / elapsed))
+
+
+# patterns checked against a scan of every headword, including escapes that
+# must not be taken for literal text
+REGEX_QUERIES = [
+    '日.*', '^日本$', '.*本', '日本?', '[日月].*', '(日|月).*', '日{1,2}.*',
+    '\\x41', '\\u65e5.*', '\\N{CJK UNIFIED IDEOGRAPH-65E5}.*', '(日)\\1',
+    '\\d', '\\w本', '.*\\.', '\\U000065e5', '.?^日', 'a*^日', '^^日本',
+]
+
+
+def regex(root='fixtures', repeat=20):
+    """Regex search latency and results against a scan of all headwords."""
+    os.chdir(os.path.abspath(root))
+    if not os.path.isdir(server.Artifact.DIRECTORY):
+        os.makedirs(server.Artifact.DIRECTORY)
+    d = server.JMdict_e().dictionary
+    keys = list(d.keys)
+
+    def scan(query):
+        pattern = server.re.compile(query)
+        return [k for k in keys if pattern.match(k)]
+
+    def search(query):
+        return d.regex_search(query, len(keys))['regex']
+
+    failed = 0
+    for query in REGEX_QUERIES:
+        expected = scan(query)
+        ok = search(query) == expected
+        failed += not ok
+        print('{:40} {:6} matches {:8.1f} us/query {:8.1f} us/scan {}'.format(
+            query, len(expected),
+            _measure(search, [query] * int(repeat)) * 1e6,
+            _measure(scan, [query] * int(repeat)) * 1e6,
+            'ok' if ok else 'MISMATCH'))
+    if failed:
+        sys.exit('{} queries differ from the scan'.format(failed))
+
+
+def _percentile(latencies, q):
+    return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+@gen.coroutine
+def _load_test(client, requests, concurrency):
+    """Send requests from concurrency parallel clients, timing each."""
+    latencies = []
+    errors = [0]
+    pending = iter(requests)
+
+    @gen.coroutine
+    def worker():
+        for request in pending:
+            start = time.time()
+            response = yield client.fetch(request, raise_error=False)
+            latencies.append(time.time() - start)
+            if response.code != 200:
+                errors[0] += 1
+
+    start = time.time()
+    yield [worker() for _ in range(concurrency)]
+    elapsed = time.time() - start
+    latencies.sort()
+    return dict(
+        requests=len(latencies),
+        errors=errors[0],
+        p50_ms=_percentile(latencies, .5) * 1e3,
+        p90_ms=_percentile(latencies, .9) * 1e3,
+        p99_ms=_percentile(latencies, .99) * 1e3,
+        max_ms=latencies[-1] * 1e3,
+        throughput=len(latencies) / elapsed,
+    )
+
+
+def endpoints(concurrency=8, requests=200, cache='no'):
+    """Loader and per-endpoint load test on the bundled fixtures, as JSON."""
+    concurrency, requests = int(concurrency), int(requests)
+    # all data paths are relative to the working directory, see fixtures/
+    root = os.path.abspath('fixtures')
+    os.chdir(root)
+    if not os.path.isdir(server.Artifact.DIRECTORY):
+        os.makedirs(server.Artifact.DIRECTORY)
+    server.Config.load()
+    server.Config.config.update(
+        mecab_path=os.path.join(root, 'bin', 'mecab'),
+        mecab_backend='subprocess',
+        mecab_workers='2',
+        # the cases repeat their inputs, which would only measure the cache
+        mecab_cache_size='0',
+        lookup_executor='thread',
+        response_cache_size='32' if cache == 'yes' else '0',
+    )
+    result = dict(concurrency=concurrency, requests=requests, cache=cache == 'yes')
+    logging.getLogger('tornado.access').setLevel(logging.WARNING)
+
+    # progress goes to stderr, leaving stdout to the results
+    with redirect_stdout(sys.stderr):
+        compile_times = dict()
+        for source in server.SOURCES:
+            compile_times[source.__name__] = server.build_index(source, True)['time']
+        start = time.time()
+        server.loader = server.load_sources()
+        for future in list(server.loader.futures.values()):
+            future.result()
+        result['startup'] = dict(compile=compile_times, load=server.loader.times,
+            time_to_ready=time.time() - start)
+
+        server.dispatcher = server.Dispatcher()
+        server.response_cache = server.ResponseCache(
+            int(float(server.Config.get('response_cache_size')) * 1e6))
+        sock, port = testing.bind_unused_port()
+        http = httpserver.HTTPServer(server.get_app())
+        http.add_sockets([sock])
+        base = 'http://127.0.0.1:{}'.format(port)
+
+        with open(os.path.join('data', 'wwwjdic.csv'), 'rb') as f:
+            sentences = [l.split('\t')[2] for l in f.read().decode('utf-8').splitlines()]
+        words = list(server.jmdict_e.dictionary.keys)
+        kanji = sorted(set(c for w in words for c in w if server.kanjidic2.freq(c)))
+        parts = sorted(set(p for k in server.kvgparts.kanji.values() for p in k))
+        tokens = server.mecab.analyze(sentences[0])
+
+        def get(path, values, **query):
+            def request(i):
+                return httpclient.HTTPRequest(httputil.url_concat(base + path,
+                    dict(query, query=values[i % len(values)])))
+            return request
+
+        def post(path, bodies):
+            def request(i):
+                return httpclient.HTTPRequest(base + path, method='POST',
+                    body=json.dumps(bodies[i % len(bodies)]))
+            return request
+
+        cases = [
+            ('mecab', post('/mecab', sentences)),
+            ('analyze', post('/analyze', sentences)),
+            ('lookup_batch', post('/lookup_batch', [[[t.to_dict() for t in tokens]]])),
+            ('jmdict_e', get('/jmdict_e', words)),
+            ('jmdict_e_regex', get('/jmdict_e', [k + '.*' for k in kanji], regex='yes')),
+            ('kanjidic2', get('/kanjidic2', kanji)),
+            ('tatoeba', get('/tatoeba', words, readings='')),
+            ('phrase', get('/phrase', words, shuffle='no')),
+            ('kvgparts', get('/kvgparts', kanji)),
+            ('kvgcombinations', get('/kvgcombinations', parts)),
+            ('kanjisimilars', get('/kanjisimilars', kanji)),
+        ]
+
+        client = httpclient.AsyncHTTPClient(max_clients=concurrency)
+        result['endpoints'] = dict()
+        for name, request in cases:
+            result['endpoints'][name] = ioloop.IOLoop.current().run_sync(
+                lambda: _load_test(client, [request(i) for i in range(requests)],
+                    concurrency))
+        http.stop()
+        for worker in server.mecab.workers:
+            worker.close()
+
+    if resource is not None:
+        # kilobytes on Linux
+        result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+        result['peak_rss_children_mb'] = (
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1e3)
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+
+BENCHMARKS = [
+    jmdict_entries,
+    dictionary,
+    mecab_backends,
+    regex,
+    endpoints,
+]
+
+
+def main():
+    benchmarks = dict((b.__name__, b) for b in BENCHMARKS)
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        for b in BENCHMARKS:
+            print('{:20} {}'.format(b.__name__, b.__doc__))
+        return
+    benchmarks[sys.argv[1]](*sys.argv[2:])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,29 +1,43 @@
 #!/usr/bin/env python3
 
-from tornado import websocket, web, ioloop
+from tornado import websocket, web, ioloop, gen, locks
 from tornado.log import enable_pretty_logging; enable_pretty_logging()
+from tornado.concurrent import is_future
 from subprocess import PIPE, Popen
 import json
 import xml.etree.ElementTree as ET
 import re
-from threading import Thread
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from collections import deque, OrderedDict
+from multiprocessing import cpu_count, get_context
 import time
 import os
 from os.path import dirname, realpath, splitext, isfile
 import sys
 import random
-if sys.version_info[0] == 3:
-    from queue import Queue, Empty
-    import pickle
-elif sys.version_info[0] == 2:
-    from Queue import Queue, Empty
-    import cPickle as pickle
+from array import array
+import hashlib
+import mmap
+import struct
+import zlib
+import gzip
+import io
+import cProfile
+import pstats
+from bisect import bisect_left
+from queue import Queue, Empty
+from sys import intern
 if os.name == 'nt':
     try:
         import win32com.client
         import pythoncom
     except:
         print('SAPI5 initialization failed. To use system TTS, please install pywin32.')
+try:
+    import MeCab
+except ImportError:
+    pass
 
 INT32_MAX = 2**31 - 1
 SVSFlagsAsync = 1
@@ -37,21 +51,442 @@ except:
 
 class Config(object):
 
+    FILE = 'mecab-translate.conf'
+
     config = dict()
-    try:
-        with open('mecab-translate.conf') as f:
-            for l in f.read().splitlines():
-                c = [t.strip() for t in l.split('=', 1)]
-                if len(c) == 2:
-                    config[c[0]] = c[1]
-    except:
-        pass
+    mtime = None
+
+    @staticmethod
+    def load():
+        """(Re)read the config file if it changed, returning True if so."""
+        try:
+            mtime = os.path.getmtime(Config.FILE)
+        except OSError:
+            mtime = None
+        if mtime == Config.mtime:
+            return False
+        Config.mtime = mtime
+        config = dict()
+        try:
+            with open(Config.FILE) as f:
+                for l in f.read().splitlines():
+                    c = [t.strip() for t in l.split('=', 1)]
+                    if len(c) == 2:
+                        config[c[0]] = c[1]
+        except:
+            pass
+        Config.config = config
+        return True
 
     @staticmethod
     def get(variable):
         return Config.config.get(variable)
 
 
+Config.load()
+
+
+class LRUCache(object):
+    """Thread-safe least recently used cache bounded by total value size."""
+
+    def __init__(self, max_size, size_of):
+        self.max_size = max_size
+        self.size_of = size_of
+        self.lock = Lock()
+        self.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.data.move_to_end(key)
+            return value[0]
+
+    def put(self, key, value):
+        size = self.size_of(key, value)
+        if size > self.max_size:
+            return
+        with self.lock:
+            old = self.data.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.data[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted) = self.data.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.data = OrderedDict()
+            self.size = 0
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+            evictions=self.evictions, entries=len(self.data),
+            size=self.size, max_size=self.max_size)
+
+
+class Metrics(object):
+    """Thread-safe counters and histograms in the Prometheus text format."""
+
+    # histogram upper bounds, in seconds
+    BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = dict()
+        # (name, labels) -> count per bucket, the last for +Inf, then the sum
+        self.histograms = dict()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(Metrics.BUCKETS) + 2)
+            histogram[bisect_left(Metrics.BUCKETS, value)] += 1
+            histogram[-1] += value
+
+    def render(self, gauges=(), counters=()):
+        """Format all metrics, plus gauges and counters kept elsewhere.
+
+        Both are given as (name, labels, value), labels being a dict.
+        """
+        families = dict()
+
+        def sample(name, family, kind, labels, value):
+            labels = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+                .replace('"', '\\"').replace('\n', '\\n')) for k, v in labels)
+            families.setdefault(family, (kind, []))[1].append('{}{} {}'.format(
+                name, '{' + labels + '}' if labels else '', repr(float(value))))
+
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                sample(name, name, 'counter', labels, value)
+            for (name, labels), histogram in self.histograms.items():
+                count = 0
+                for bound, n in zip(Metrics.BUCKETS + ('+Inf',), histogram):
+                    count += n
+                    sample(name + '_bucket', name, 'histogram',
+                        labels + (('le', bound),), count)
+                sample(name + '_sum', name, 'histogram', labels, histogram[-1])
+                sample(name + '_count', name, 'histogram', labels, count)
+        for kind, external in (('gauge', gauges), ('counter', counters)):
+            for name, labels, value in external:
+                sample(name, name, kind, tuple(sorted(labels.items())), value)
+
+        lines = []
+        for family in sorted(families):
+            kind, samples = families[family]
+            lines.append('# TYPE {} {}'.format(family, kind))
+            # in insertion order, which keeps buckets in increasing le order
+            lines += samples
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class Profiler(object):
+    """cProfile window over the IO loop and the lookups it dispatches."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.active = False
+        self.profiles = []
+
+    def start(self):
+        # profiles the calling thread, the IO loop
+        self.profiles = [cProfile.Profile()]
+        self.profiles[0].enable()
+        self.active = True
+
+    def stop(self):
+        self.active = False
+        self.profiles[0].disable()
+        with self.lock:
+            stats = pstats.Stats(self.profiles[0], stream=io.StringIO())
+            for profile in self.profiles[1:]:
+                stats.add(profile)
+            self.profiles = []
+        return stats
+
+    def call(self, fn, *args):
+        """Run fn(*args), profiled in its own thread while a window is open."""
+        if not self.active:
+            return fn(*args)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12 allows only one active profiler
+            return fn(*args)
+        try:
+            return fn(*args)
+        finally:
+            profile.disable()
+            with self.lock:
+                if self.active:
+                    self.profiles.append(profile)
+
+
+profiler = Profiler()
+
+
+class Artifact(object):
+    """Versioned binary index file under data/cache.
+
+    The file starts with a magic string and a JSON header holding the
+    format version, a fingerprint of the source files and a table of
+    8-byte aligned, CRC-32 checksummed sections. Sections are typed arrays
+    that are read back zero-copy from a read-only memory map.
+    """
+
+    MAGIC = b'MTIDX002'
+    DIRECTORY = 'data/cache'
+    # bytes hashed from both ends of every source file
+    SAMPLE = 1 << 16
+    # refuse to compile sources at startup, see --artifacts-only
+    artifacts_only = False
+
+    def __init__(self, name, version, sources):
+        self.path = os.path.join(Artifact.DIRECTORY, name + '.idx')
+        self.version = version
+        self.sources = sources
+        self.meta = dict()
+        self._map = None
+        self._sections = dict()
+
+    def __getitem__(self, name):
+        return self._sections[name]
+
+    @staticmethod
+    def open(name, version, sources, compile):
+        """Load an artifact, calling compile(artifact) first if it is stale."""
+        artifact = Artifact(name, version, sources)
+        start = time.time()
+        if artifact.load():
+            print('loaded {} index in {:.3f} s'.format(name, time.time() - start))
+            return artifact
+        # verified at startup by check_artifacts, but changed since
+        if Artifact.artifacts_only:
+            raise RuntimeError('{} is missing or stale, run ./server.py '
+                '--build-indexes'.format(artifact.path))
+        compile(artifact)
+        artifact.load()
+        return artifact
+
+    def fingerprint(self):
+        fingerprint = []
+        for source in self.sources:
+            digest = hashlib.sha1()
+            if os.path.isdir(source):
+                # a manifest of every file's name, size and mtime
+                names = sorted(os.listdir(source))
+                for name in names:
+                    st = os.stat(os.path.join(source, name))
+                    digest.update('{}\0{}\0{}\n'.format(
+                        name, st.st_size, int(st.st_mtime)).encode('utf-8'))
+                fingerprint.append([source, len(names), digest.hexdigest()])
+                continue
+            st = os.stat(source)
+            with open(source, 'rb') as f:
+                digest.update(f.read(Artifact.SAMPLE))
+                f.seek(max(0, st.st_size - Artifact.SAMPLE))
+                digest.update(f.read())
+            fingerprint.append([source, st.st_size, int(st.st_mtime),
+                digest.hexdigest()])
+        return fingerprint
+
+    def load(self):
+        """Map the artifact, returning False if it is missing or stale."""
+        if not isfile(self.path):
+            return False
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < len(Artifact.MAGIC) + 4:
+                return False
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._map)
+        try:
+            if bytes(view[:len(Artifact.MAGIC)]) != Artifact.MAGIC:
+                raise ValueError('bad magic')
+            header_start = len(Artifact.MAGIC) + 4
+            header_length, = struct.unpack(
+                '<I', view[len(Artifact.MAGIC):header_start])
+            header = json.loads(bytes(
+                view[header_start:header_start + header_length]).decode('utf-8'))
+            if (header['version'] != self.version or
+                    header['byteorder'] != sys.byteorder or
+                    header['fingerprint'] != self.fingerprint()):
+                raise ValueError('stale')
+        except (ValueError, OSError):
+            view.release()
+            self.close()
+            return False
+        self.meta = header['meta']
+        # identifies the data, for caches of anything derived from it
+        self.digest = hashlib.sha1(json.dumps(
+            [header['version'], header['fingerprint']]).encode('utf-8')).hexdigest()[:16]
+        self._checksums = dict()
+        data_start = header_start + header_length
+        for name, typecode, offset, length, crc in header['sections']:
+            offset += data_start
+            self._sections[name] = view[offset:offset + length].cast(typecode)
+            self._checksums[name] = crc
+        return True
+
+    def verify(self):
+        """Check the loaded sections against their checksums."""
+        return all(zlib.crc32(self._sections[name]) == crc
+            for name, crc in self._checksums.items())
+
+    def save(self, sections, meta=None):
+        """Write sections, a list of (name, array) pairs, atomically."""
+        self.close()
+        table = []
+        offset = 0
+        for name, data in sections:
+            typecode = data.typecode if isinstance(data, array) else 'B'
+            length = len(data) * (data.itemsize if isinstance(data, array) else 1)
+            table.append([name, typecode, offset, length, zlib.crc32(data)])
+            offset += length + (-length % 8)
+        header = json.dumps(dict(
+            version=self.version,
+            byteorder=sys.byteorder,
+            fingerprint=self.fingerprint(),
+            sections=table,
+            meta=meta or dict(),
+        )).encode('utf-8')
+        header += b' ' * (-(len(Artifact.MAGIC) + 4 + len(header)) % 8)
+
+        temp = self.path + '.tmp'
+        with open(temp, 'wb') as f:
+            f.write(Artifact.MAGIC)
+            f.write(struct.pack('<I', len(header)))
+            f.write(header)
+            for name, data in sections:
+                data = data.tobytes() if isinstance(data, array) else data
+                f.write(data)
+                f.write(b'\0' * (-len(data) % 8))
+        os.replace(temp, self.path)
+
+    def close(self):
+        self._sections = dict()
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # views are still exported, let the gc unmap it
+                pass
+            self._map = None
+
+
+class MappedFile(object):
+    """Read-only memory map of a data file.
+
+    Reads are zero-copy memoryview slices at absolute positions, so unlike
+    a shared file object with seek() and read() it is safe to use from
+    many threads at once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                # empty files cannot be mapped
+                self._map = b''
+        self.view = memoryview(self._map)
+
+    def __len__(self):
+        return len(self.view)
+
+    def read(self, position, length):
+        return self.view[position:position + length]
+
+    def lines(self):
+        """Yield (position, line) for every line, the newline included."""
+        position = 0
+        size = len(self.view)
+        while position < size:
+            end = self._map.find(b'\n', position) + 1 or size
+            yield position, self._map[position:end]
+            position = end
+
+    def close(self):
+        self.view.release()
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+
+
+class ResponseCache(object):
+    """Serialized and gzip compressed response bodies with their ETags."""
+
+    def __init__(self, max_size):
+        self.cache = LRUCache(max_size, ResponseCache._size)
+        self.not_modified = 0
+        self.bytes_saved = 0
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def put(self, key, body):
+        """Cache body, returning its (etag, body, gzipped body or None)."""
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest()[:20])
+        compressed = gzip.compress(body)
+        entry = (etag, body, compressed if len(compressed) < len(body) else None)
+        self.cache.put(key, entry)
+        return entry
+
+    def stats(self):
+        stats = self.cache.stats()
+        lookups = stats['hits'] + stats['misses']
+        stats.update(hit_rate=stats['hits'] / lookups if lookups else None,
+            not_modified=self.not_modified, bytes_saved=self.bytes_saved)
+        return stats
+
+    @staticmethod
+    def _size(key, entry):
+        return len(entry[1]) + len(entry[2] or b'') + 200
+
+
+class StringTable(object):
+    """Sequence of strings packed into one UTF-8 blob with an offset array."""
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    @staticmethod
+    def pack(strings):
+        offsets = array('I', [0])
+        blob = bytearray()
+        for s in strings:
+            blob += s.encode('utf-8')
+            offsets.append(len(blob))
+        return bytes(blob), offsets
+
+
 class TTS(object):
 
     def __init__(self):
@@ -129,6 +564,206 @@ class TTSEventSink(object):
         self.tts.handle_event('end')
 
 
+class MecabWorker(object):
+    """A mecab process answering lines in the order they were written.
+
+    Every input line produces exactly one EOS-terminated block of output,
+    so results are matched to requests through a FIFO of futures. A
+    writer thread feeds stdin and a reader thread drains stdout; if the
+    process exits, pending requests fail and a new process is started.
+    """
+
+    def __init__(self, args, parse):
+        self.args = args
+        self.parse = parse
+        self.lock = Lock()
+        self.closed = False
+        self._start()
+
+    def _start(self):
+        self.started = time.time()
+        self.pending = deque()
+        self.input = Queue()
+        self.process = Popen(self.args, stdout=PIPE, stdin=PIPE)
+        for target in (self._handle_stdin, self._handle_stdout):
+            t = Thread(target=target, args=(self.process, self.input))
+            t.daemon = True
+            t.start()
+
+    def submit(self, text):
+        return self.submit_batch([text])[0]
+
+    def submit_batch(self, lines):
+        """Queue lines as a single write, returning a Future per line."""
+        futures = [Future() for _ in lines]
+        text = ''.join(line.replace('\n', ' ') + '\n' for line in lines)
+        with self.lock:
+            self.pending.extend(futures)
+            self.input.put(text)
+        return futures
+
+    def load(self):
+        return len(self.pending)
+
+    def close(self):
+        """Let the process finish what is queued, then exit for good."""
+        with self.lock:
+            self.closed = True
+            self.input.put(None)
+
+    def _handle_stdin(self, process, input):
+        while True:
+            # coalesce whatever is queued into a single write
+            text = [input.get()]
+            while True:
+                try:
+                    text.append(input.get(False))
+                except Empty:
+                    break
+            closing = None in text
+            if closing:
+                text = text[:text.index(None)]
+            try:
+                process.stdin.write(''.join(text).encode('utf-8'))
+                process.stdin.flush()
+                if closing:
+                    process.stdin.close()
+                    return
+            except (IOError, OSError, ValueError):
+                # the reader notices the exit and restarts the worker
+                return
+
+    def _handle_stdout(self, process, input):
+        lines = []
+        for line in iter(process.stdout.readline, b''):
+            line = line.decode('utf-8').strip()
+            if line != 'EOS':
+                lines.append(line)
+                continue
+            with self.lock:
+                future = self.pending.popleft()
+            try:
+                future.set_result(self.parse(lines))
+            except Exception as e:
+                future.set_exception(e)
+            lines = []
+        process.stdout.close()
+        process.wait()
+        self._restart(process)
+
+    def _restart(self, process):
+        if not self.closed and time.time() - self.started < 1:
+            time.sleep(1)
+        with self.lock:
+            for future in self.pending:
+                future.set_exception(RuntimeError('mecab exited'))
+            if self.closed:
+                self.pending.clear()
+                return
+            print('mecab exited with {}, restarting'.format(process.returncode))
+            self._start()
+
+
+class MecabBinding(object):
+    """In-process counterpart of MecabWorker using the MeCab Python binding.
+
+    A Tagger is not thread-safe, so each one is owned by a single thread.
+    """
+
+    def __init__(self, args, token):
+        self.token = token
+        # MeCab splits the options at whitespace outside double quotes
+        self.tagger = MeCab.Tagger(' '.join(
+            '"{}"'.format(a) if re.search(r'\s', a) else a for a in args[1:]))
+        self.executor = ThreadPoolExecutor(1)
+        self.lock = Lock()
+        self.pending = 0
+
+    def submit(self, text):
+        return self.submit_batch([text])[0]
+
+    def submit_batch(self, lines):
+        futures = [Future() for _ in lines]
+        with self.lock:
+            self.pending += len(lines)
+        self.executor.submit(self._analyze, lines, futures)
+        return futures
+
+    def load(self):
+        return self.pending
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def _analyze(self, lines, futures):
+        for line, future in zip(lines, futures):
+            try:
+                result = []
+                node = self.tagger.parseToNode(line)
+                while node:
+                    if node.stat not in (MeCab.MECAB_BOS_NODE, MeCab.MECAB_EOS_NODE):
+                        result.append(self.token(node.surface, node.feature))
+                    node = node.next
+                future.set_result(result)
+            except Exception as e:
+                future.set_exception(e)
+            with self.lock:
+                self.pending -= 1
+
+
+class Token(tuple):
+    """One analyzed word: the literal followed by the dictionary's fields.
+
+    Subclasses made by Token.for_format name the fields. Like the dicts
+    this replaces, a token may have fewer fields than the format when
+    MeCab outputs fewer features, for example for unknown words.
+    """
+
+    __slots__ = ()
+
+    FIELDS = ('literal',)
+    # part-of-speech and inflection values repeat across most tokens
+    CATEGORICAL = ('pos', 'pos2', 'pos3', 'pos4', 'inflection_type',
+        'inflection_form')
+
+    @staticmethod
+    def for_format(dictionary_format):
+        fields = ('literal',) + tuple(dictionary_format)
+        return type('Token', (Token,), dict(
+            __slots__=(),
+            FIELDS=fields,
+            INDEX=dict((f, i) for i, f in enumerate(fields)),
+            INTERN=frozenset(i for i, f in enumerate(fields)
+                if f in Token.CATEGORICAL),
+        ))
+
+    @classmethod
+    def parse(cls, literal, features):
+        values = [literal]
+        for i, value in enumerate(features.split(',')[:len(cls.FIELDS) - 1], 1):
+            if value == '*':
+                value = ''
+            elif i in cls.INTERN:
+                value = intern(value)
+            values.append(value)
+        return cls(values)
+
+    def get(self, field, default=None):
+        i = self.INDEX.get(field)
+        if i is None or i >= len(self):
+            return default
+        return self[i]
+
+    def to_dict(self):
+        return dict(zip(self.FIELDS, self))
+
+    @classmethod
+    def columns(cls, tokens):
+        """Transpose tokens into one list per field, missing values as None."""
+        return [[t[i] if i < len(t) else None for t in tokens]
+            for i in range(len(cls.FIELDS))]
+
+
 class Mecab(object):
 
     IPADIC = ['pos', 'pos2', 'pos3', 'pos4', 'inflection_type',
@@ -138,164 +773,615 @@ class Mecab(object):
         'inflection_form', 'lemma_reading', 'lemma', '_', 'reading']
 
     def __init__(self):
+        self.workers = []
+        self.cache = LRUCache(
+            int(float(Config.get('mecab_cache_size') or 64) * 1e6), Mecab._size)
+        self._configure()
+
+    def _configure(self):
+        """Start workers for the current config, retiring any old ones."""
         self.dictionary_format = Mecab.IPADIC
         dic_f = Config.get('mecab_dictionary_format')
         if dic_f == 'unidic':
             self.dictionary_format = Mecab.UNIDIC
         elif dic_f and dic_f != 'ipadic':
             print('unknown mecab_dictionary_format: {}'.format(dic_f))
-        args = ['mecab']
+        Token_ = Token.for_format(self.dictionary_format)
+        args = [Config.get('mecab_path') or 'mecab']
         if Config.get('mecab_dictionary'):
             args += ['-d', Config.get('mecab_dictionary')]
-        self.process = Popen(args, stdout=PIPE, stdin=PIPE, bufsize=1)
-        self.output = Queue()
-        self.t = Thread(target=self._handle_stdout)
-        self.t.daemon = True
-        self.t.start()
+        workers = int(Config.get('mecab_workers') or cpu_count())
+        backend = Config.get('mecab_backend') or 'subprocess'
+        if backend == 'binding' and 'MeCab' not in globals():
+            print('MeCab binding not found, using the mecab executable. '
+                'To analyze in-process, please install mecab-python3.')
+            backend = 'subprocess'
+        elif backend not in ('binding', 'subprocess'):
+            print('unknown mecab_backend: {}'.format(backend))
+            backend = 'subprocess'
+
+        old_workers = self.workers
+        if backend == 'binding':
+            self.workers = [MecabBinding(args, Token_.parse) for _ in range(workers)]
+        else:
+            parse = lambda lines: Mecab._parse(Token_, lines)
+            self.workers = [MecabWorker(args, parse) for _ in range(workers)]
+        for worker in old_workers:
+            worker.close()
+
+        self.Token = Token_
+        self.backend = backend
+        self.cache_key = (dic_f or 'ipadic', Config.get('mecab_dictionary') or '')
+        self.cache.clear()
+        self.config_checked = time.time()
+
+    def _check_config(self):
+        if time.time() - self.config_checked < 1:
+            return
+        self.config_checked = time.time()
+        if Config.load():
+            key = (Config.get('mecab_dictionary_format') or 'ipadic',
+                Config.get('mecab_dictionary') or '')
+            if key != self.cache_key:
+                print('mecab dictionary changed, restarting mecab')
+                self._configure()
 
     def analyze(self, text):
-        self.process.stdin.write((text + '\n').encode('utf-8'))
-        self.process.stdin.flush()
+        return self.analyze_async(text).result()
+
+    def analyze_async(self, text):
+        """Analyze one line, returning a Future."""
+        return self.analyze_batch([text])[0]
+
+    def analyze_batch(self, lines):
+        """Analyze many lines, returning a Future per line in order.
+
+        Cached lines are answered immediately. The rest are split into one
+        contiguous chunk per worker and each chunk is written to its
+        process in one go.
+        """
+        self._check_config()
+        futures = [None] * len(lines)
+        misses = []
+        for i, line in enumerate(lines):
+            tokens = self.cache.get((line,) + self.cache_key)
+            if tokens is None:
+                misses.append(i)
+            else:
+                futures[i] = Future()
+                futures[i].set_result(tokens)
+
+        workers = sorted(self.workers, key=lambda w: w.load())
+        size = -(-len(misses) // len(workers)) or 1
+        submitted_at = time.time()
+        for start, worker in zip(range(0, len(misses), size), workers):
+            chunk = misses[start:start + size]
+            submitted = worker.submit_batch([lines[i] for i in chunk])
+            for i, future in zip(chunk, submitted):
+                future.add_done_callback(self._cache_callback(
+                    (lines[i],) + self.cache_key, submitted_at))
+                futures[i] = future
+        return futures
+
+    def _cache_callback(self, key, submitted_at):
+        def callback(future):
+            metrics.observe('mecab_line_seconds', time.time() - submitted_at,
+                backend=self.backend)
+            if not future.exception():
+                self.cache.put(key, future.result())
+        return callback
 
-        result = []
-        while True:
-            line = self.output.get()
-            if line == 'EOS':
-                break
+    @staticmethod
+    def _size(key, tokens):
+        # rough bytes: string contents plus per-object overhead
+        return 100 + len(key[0]) * 2 + sum(
+            80 + 8 * len(t) + sum(len(v) for v in t) * 2 for t in tokens)
 
+    @staticmethod
+    def _parse(Token, lines):
+        result = []
+        for line in lines:
             try:
-                part = dict()
-                part['literal'], line = line.split('\t')
-                part.update(zip(self.dictionary_format,
-                    ['' if i == '*' else i for i in line.split(',')]))
-            except Exception as e:
+                literal, features = line.split('\t')
+            except ValueError as e:
                 print(e)
-            result.append(part)
+                result.append(Token())
+                continue
+            result.append(Token.parse(literal, features))
         return result
 
-    def _handle_stdout(self):
-        for line in iter(self.process.stdout.readline, b''):
-            self.output.put(line.decode('utf-8').strip())
-        self.process.stdout.close()
 
+class Trie(object):
+    """Array-backed prefix tree over a sorted list of keys.
 
-class Dictionary(object):
+    Nodes are numbered breadth first, so the children of a node are the
+    contiguous range first[node]:first[node + 1], ordered by the code
+    point in labels. Every node also stores the range lo:hi of key ids
+    below it, which makes prefix completion a slice of the key table.
+    """
 
-    def __init__(self, dictionary):
-        self.dictionary = list(dictionary.items())
-        self.dictionary.sort(key=lambda e: e[0])
+    SECTIONS = ('labels', 'first', 'lo', 'hi', 'terminal')
 
-    def regex_search(self, query):
-        results = dict(exact=None, shorter=None, longer=[], regex=[])
+    def __init__(self, labels, first, lo, hi, terminal):
+        self.labels = labels
+        self.first = first
+        self.lo = lo
+        self.hi = hi
+        self.terminal = terminal
 
-        pattern = re.compile(query)
+    @staticmethod
+    def pack(keys, prefix='trie_'):
+        """Build the node arrays for sorted keys as artifact sections."""
+        labels = array('I', [0])
+        first = array('I')
+        lo = array('I', [0])
+        hi = array('I', [len(keys)])
+        terminal = array('B')
+        depths = [0]
+
+        node = 0
+        while node < len(labels):
+            depth = depths[node]
+            start, end = lo[node], hi[node]
+            first.append(len(labels))
+            is_terminal = start < end and len(keys[start]) == depth
+            terminal.append(is_terminal)
+            i = start + 1 if is_terminal else start
+            while i < end:
+                char = keys[i][depth]
+                j = i + 1
+                while j < end and keys[j][depth] == char:
+                    j += 1
+                labels.append(ord(char))
+                lo.append(i)
+                hi.append(j)
+                depths.append(depth + 1)
+                i = j
+            node += 1
+        first.append(len(labels))
+
+        return [(prefix + name, data) for name, data in
+            zip(Trie.SECTIONS, (labels, first, lo, hi, terminal))]
 
-        for w in self.dictionary:
-            if pattern.match(w[0]):
-                results['regex'].append(w[0])
+    @staticmethod
+    def from_artifact(artifact, prefix='trie_'):
+        return Trie(*[artifact[prefix + name] for name in Trie.SECTIONS])
+
+    def walk(self, key):
+        """Follow key from the root.
+
+        Returns the node reached (None if the path breaks off) and the
+        deepest terminal node passed on the way that is a proper,
+        non-empty prefix of key.
+        """
+        labels = self.labels
+        first = self.first
+        node = 0
+        shorter = None
+        for depth, char in enumerate(key):
+            if depth and self.terminal[node]:
+                shorter = node
+            code = ord(char)
+            end = first[node + 1]
+            node = bisect_left(labels, code, first[node], end)
+            if node == end or labels[node] != code:
+                return None, shorter
+        return node, shorter
+
+    def key_id(self, node):
+        return self.lo[node]
+
+    def prefix_range(self, prefix):
+        node, _ = self.walk(prefix)
+        if node is None:
+            return 0, 0
+        return self.lo[node], self.hi[node]
+
+
+class NgramIndex(object):
+    """Inverted index from character n-grams to sorted document ids.
+
+    Bigrams are always indexed, unigrams optionally. Grams are packed
+    into integer codes kept in a sorted array, each pointing to a slice
+    of the shared postings array.
+    """
+
+    SECTIONS = ('grams', 'offsets', 'values')
+
+    def __init__(self, grams, offsets, values):
+        self.grams = grams
+        self.offsets = offsets
+        self.values = values
 
-        return results
+    @staticmethod
+    def code(gram):
+        if len(gram) == 1:
+            return ord(gram)
+        return 1 << 42 | ord(gram[0]) << 21 | ord(gram[1])
 
-    def get(self, key):
-        results = dict(exact=None, shorter=None, longer=[])
+    @staticmethod
+    def pack(documents, unigrams=False, prefix='ngram_'):
+        """Index an iterable of strings, document ids being their positions."""
+        code = NgramIndex.code
+        postings = dict()
+        for doc_id, text in enumerate(documents):
+            grams = set(text[i:i + 2] for i in range(len(text) - 1))
+            if unigrams:
+                grams.update(text)
+            for gram in grams:
+                c = code(gram)
+                if c not in postings:
+                    postings[c] = array('I')
+                postings[c].append(doc_id)
+
+        grams = array('Q', sorted(postings))
+        offsets = array('I', [0])
+        values = array('I')
+        for c in grams:
+            values.extend(postings[c])
+            offsets.append(len(values))
+        return [(prefix + name, data) for name, data in
+            zip(NgramIndex.SECTIONS, (grams, offsets, values))]
 
-        if not key:
-            return results
+    @staticmethod
+    def from_artifact(artifact, prefix='ngram_'):
+        return NgramIndex(*[artifact[prefix + name] for name in NgramIndex.SECTIONS])
 
-        index = self._search_dict(key)
+    @staticmethod
+    def grams(text):
+        """Bigrams covering text, or the text itself if it is shorter."""
+        if len(text) < 2:
+            return [text] if text else []
+        return [text[i:i + 2] for i in range(len(text) - 1)]
+
+    def postings(self, gram):
+        c = NgramIndex.code(gram)
+        i = bisect_left(self.grams, c)
+        if i == len(self.grams) or self.grams[i] != c:
+            return self.values[0:0]
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def search(self, grams, lo=0, hi=None):
+        """Ids within lo:hi that contain every gram, in ascending order."""
+        postings = []
+        for gram in set(grams):
+            p = self.postings(gram)
+            start = bisect_left(p, lo)
+            end = len(p) if hi is None else bisect_left(p, hi)
+            postings.append(p[start:end])
+        if not postings:
+            return None
+        postings.sort(key=len)
+        result = postings[0].tolist()
+        for p in postings[1:]:
+            if not result:
+                break
+            n = len(p)
+            kept = []
+            for doc_id in result:
+                i = bisect_left(p, doc_id)
+                if i < n and p[i] == doc_id:
+                    kept.append(doc_id)
+            result = kept
+        return result
 
-        if index is None:
-            # shorter
-            shorter = key[:-1]
-            while shorter:
-                shorter_index = self._search_dict(shorter)
-                if shorter_index is not None:
-                    results['shorter'] = self.dictionary[shorter_index][1]
-                    break
-                shorter = shorter[:-1]
-            # prepare for longer
-            index = self._search_dict(key, False)
-            while True:
-                if index >= 0:
-                    entry = self.dictionary[index]
-                else:
-                    break
-                if not entry[0][0] == key[0]:
-                    break
-                index -= 1
-        else:
-            results['exact'] = self.dictionary[index][1]
 
-        while True:
-            index += 1
-            if index >= len(self.dictionary):
+class Dictionary(object):
+    """Headword index mapping each key to a list of entry ids."""
+
+    def __init__(self, keys, trie, postings, values, ngrams):
+        self.keys = keys
+        self.trie = trie
+        self.postings = postings
+        self.values = values
+        self.ngrams = ngrams
+
+    @staticmethod
+    def pack(dictionary):
+        """Flatten a dict of key -> [entry id] into artifact sections."""
+        items = sorted(dictionary.items(), key=lambda e: e[0])
+        keys = [k for k, _ in items]
+        blob, offsets = StringTable.pack(keys)
+        postings = array('I', [0])
+        values = array('I')
+        for _, ids in items:
+            values.extend(ids)
+            postings.append(len(values))
+        return ([('keys', blob), ('key_offsets', offsets),
+            ('postings', postings), ('values', values)] +
+            Trie.pack(keys) + NgramIndex.pack(keys))
+
+    @staticmethod
+    def from_artifact(artifact):
+        return Dictionary(
+            StringTable(artifact['keys'], artifact['key_offsets']),
+            Trie.from_artifact(artifact),
+            artifact['postings'], artifact['values'],
+            NgramIndex.from_artifact(artifact))
+
+    @staticmethod
+    def _regex_literals(query):
+        """Find the literal prefix and other literal runs of a pattern.
+
+        Every key matched by the pattern starts with the prefix and
+        contains all of the runs. The analysis is conservative: anything
+        that is not plainly a literal ends the current run.
+        """
+        # alternation, and escapes spelling a character or group by number
+        # or name, which would be read as literal digits and letters
+        if '|' in query or '(?' in query or re.search(r'\\[xuUN0-9]', query):
+            return '', []
+
+        runs = []
+        run = ''
+        prefix = None
+        i = 0
+        while i < len(query):
+            c = query[i]
+            literal = None
+            if c == '\\':
+                escaped = query[i + 1:i + 2]
+                if escaped and not escaped.isalnum():
+                    literal = escaped
+                i += 2
+            elif c == '^' and i == 0:
+                i += 1
+                continue
+            elif c == '[' or c == '(':
+                i = Dictionary._skip_regex_group(query, i)
+            elif c == '{':
+                repeat = re.match(r'{\d*,?\d*}', query[i:])
+                i += len(repeat.group()) if repeat else 1
+            elif c in '^.$*+?}()[]':
+                i += 1
+            else:
+                literal = c
+                i += 1
+
+            # a literal followed by *, ? or {m,n} may be absent
+            if literal is not None and query[i:i + 1] not in ('*', '?', '{'):
+                run += literal
+                continue
+            if prefix is None:
+                prefix = run
+            runs.append(run)
+            run = ''
+        if prefix is None:
+            prefix = run
+        runs.append(run)
+        return prefix, [r for r in runs if len(r) > 1]
+
+    @staticmethod
+    def _skip_regex_group(query, i):
+        """Index after the character class or group starting at i."""
+        depth = 0
+        while i < len(query):
+            c = query[i]
+            if c == '\\':
+                i += 2
+                continue
+            if c == '[':
+                i += 1
+                if query[i:i + 1] == '^':
+                    i += 1
+                if query[i:i + 1] == ']':
+                    i += 1
+                while i < len(query) and query[i] != ']':
+                    i += 2 if query[i] == '\\' else 1
+                if not depth:
+                    return i + 1
+            elif c == '(':
+                depth += 1
+            elif c == ')':
+                depth -= 1
+                if not depth:
+                    return i + 1
+            i += 1
+        return i
+
+    @staticmethod
+    def compile_regex(query):
+        """Compile a search pattern, refusing repeated groups that repeat.
+
+        A repeat nested in another, as in (a+)* or (.*)*x, can take time
+        exponential in the key length for a single match, which the
+        timeout of regex_search could not interrupt.
+        """
+        pattern = re.compile(query)
+        # per open group, whether it has a repeat inside
+        groups = [False]
+        i = 0
+        while i < len(query):
+            c = query[i]
+            if c == '\\':
+                i += 2
+                continue
+            if c == '[':
+                i = Dictionary._skip_regex_group(query, i)
+                continue
+            i += 1
+            if c == '(':
+                groups.append(False)
+            elif c == ')' and len(groups) > 1:
+                inner = groups.pop()
+                if inner and query[i:i + 1] in ('*', '+', '{'):
+                    raise ValueError('nested repeats are not supported')
+                groups[-1] = groups[-1] or inner
+            elif c in '*+{':
+                groups[-1] = True
+        return pattern
+
+    def regex_search(self, query, limit, offset=0, timeout=None):
+        results = dict(exact=None, shorter=None, longer=[], regex=[],
+            regex_more=False, regex_timeout=False)
+
+        pattern = Dictionary.compile_regex(query)
+        prefix, runs = Dictionary._regex_literals(query)
+
+        lo, hi = self.trie.prefix_range(prefix) if prefix else (0, len(self.keys))
+        grams = [g for r in runs for g in NgramIndex.grams(r)]
+        candidates = self.ngrams.search(grams, lo, hi) if grams else None
+        if candidates is None:
+            candidates = range(lo, hi)
+
+        deadline = timeout and time.time() + timeout
+        skip = offset
+        for i in candidates:
+            if deadline and time.time() > deadline:
+                results['regex_timeout'] = True
                 break
-            entry = self.dictionary[index]
-            if entry[0] < key:
+            w = self.keys[i]
+            if not pattern.match(w):
                 continue
-            if entry[0].startswith(key):
-                results['longer'].append(entry[0])
+            if skip:
+                skip -= 1
+            elif len(results['regex']) < limit:
+                results['regex'].append(w)
             else:
+                results['regex_more'] = True
                 break
 
         return results
 
-    def _search_dict(self, key, exact=True):
-        imax = len(self.dictionary) - 1
-        imin = 0
+    def get(self, key, limit=None):
+        results = dict(exact=None, shorter=None, longer=[])
 
-        while imin <= imax:
+        if not key:
+            return results
 
-            imid = int((imin + imax) / 2)
+        node, shorter = self.trie.walk(key)
 
-            if self.dictionary[imid][0] == key:
-                return imid
+        if node is not None and self.trie.terminal[node]:
+            results['exact'] = self._values(self.trie.key_id(node))
+        elif shorter is not None:
+            results['shorter'] = self._values(self.trie.key_id(shorter))
 
-            elif self.dictionary[imid][0] < key:
-                imin = imid + 1
+        if node is not None:
+            start, end = self.trie.lo[node], self.trie.hi[node]
+            if self.trie.terminal[node]:
+                start += 1
+            if limit is not None:
+                end = min(end, start + limit)
+            results['longer'] = [self.keys[i] for i in range(start, end)]
 
-            else:
-                imax = imid - 1
+        return results
 
-        if not exact:
-            return imin
+    def _values(self, index):
+        return list(self.values[self.postings[index]:self.postings[index + 1]])
 
 
 class JMdict_e(object):
 
-    def __init__(self):
-        self.dictfile = open('data/JMdict_e', 'rb')
-        self.temp_dictionary = dict()
-        self.entities = dict()
-        self._parse()
-        self.dictionary = Dictionary(self.temp_dictionary)
-        del self.temp_dictionary
+    VERSION = 4
+    ARTIFACT = ('jmdict_e', VERSION, ['data/JMdict_e'])
+
+    # MeCab parts of speech and the entities they correspond to, and the
+    # priorities of common words, as ranked by the client
+    MECAB_POS = {
+        '助詞': ['prt', 'aux'],
+        '助動詞': ['aux-v', 'aux-adj'],
+        '接尾辞': ['suf', 'n-suf'],
+        '接頭辞': ['pref'],
+        '接頭詞': ['pref'],
+        '感動詞': ['int'],
+        '接続詞': ['conj'],
+        '副詞': ['adv'],
+        '連体詞': ['adj-pn'],
+    }
+    COMMON = frozenset(['news1', 'ichi1', 'spec1', 'spec2', 'gai1'])
 
-    def get(self, word, regex=False):
+    def __init__(self):
+        self.index = Artifact.open(*JMdict_e.ARTIFACT, compile=JMdict_e.compile)
+        self.entities = self.index.meta['entities']
+        self.entry_pos = self.index['entry_pos']
+        self.entry_len = self.index['entry_len']
+        self.records = self.index['records']
+        self.record_offsets = self.index['record_offsets']
+        self.dictionary = Dictionary.from_artifact(self.index)
+        # (word, reading, pos) -> best entry id, -1 for none
+        self.resolved = LRUCache(
+            int(Config.get('analyze_cache_entries') or 100000), lambda k, v: 1)
+
+    def get(self, word, regex=False, limit=None, offset=0):
 
+        start = time.time()
         if regex:
-            return self.dictionary.regex_search(word)
+            res = self.dictionary.regex_search(word,
+                limit or int(Config.get('regex_limit') or 1000), offset,
+                float(Config.get('regex_timeout') or 1))
+            metrics.observe('jmdict_e_lookup_seconds', time.time() - start,
+                phase='regex')
+            return res
 
-        res = self.dictionary.get(word)
+        res = self.dictionary.get(word, limit)
+        searched = time.time()
 
         if res['exact']:
             res['exact'] = [self._entry(e) for e in res['exact']]
         if res['shorter']:
             res['shorter'] = [self._entry(e) for e in res['shorter']]
 
+        metrics.observe('jmdict_e_lookup_seconds', searched - start, phase='index')
+        metrics.observe('jmdict_e_lookup_seconds', time.time() - searched,
+            phase='decode')
         return res
 
+    def get_batch(self, words, limit=None):
+        """Look up distinct words, returning results by word and entries by id."""
+        results = dict()
+        entries = dict()
+        for word in set(words):
+            res = results[word] = self.dictionary.get(word, limit)
+            for e in (res['exact'] or []) + (res['shorter'] or []):
+                if e not in entries:
+                    entries[e] = self._entry(e)
+        return results, entries
+
+    def annotate(self, tokens):
+        """Add the id of the best matching entry to each token dict."""
+        for t in tokens:
+            t['entry'] = self.best_entry(
+                (t.get('lemma') or '').split('-')[0] or t['literal'],
+                t.get('lemma_reading') or t.get('reading'), t.get('pos'))
+        return tokens
+
+    def best_entry(self, word, reading=None, pos=None):
+        key = (word, reading, pos)
+        best = self.resolved.get(key)
+        if best is None:
+            res = self.dictionary.get(word, 0)
+            candidates = res['exact'] or res['shorter'] or []
+            best = -1
+            if candidates:
+                # the first of the best ranked, like the client's stable sort
+                best = max(candidates,
+                    key=lambda e: self._rank(self._entry(e), reading, pos))
+            self.resolved.put(key, best)
+        return best if best >= 0 else None
+
+    @staticmethod
+    def _rank(entry, reading, pos):
+        readings = [r['text'] for r in entry['readings']]
+        has_reading = bool(reading) and (reading in readings or
+            ''.join(chr(ord(c) - 0x60) if '\u30a1' <= c <= '\u30f6' else c
+                for c in reading) in readings)
+        edict_pos = JMdict_e.MECAB_POS.get(pos) or []
+        has_pos = any(p[0] in edict_pos
+            for t in entry['translations'] for p in t['pos'])
+        common = any(JMdict_e.COMMON.intersection(w['pri'])
+            for w in entry['words'] + entry['readings'])
+        return has_reading, has_pos, common
+
     def _entry(self, entry):
-        ent = self.entities
+        start, end = self.record_offsets[entry], self.record_offsets[entry + 1]
+        return json.loads(bytes(self.records[start:end]).decode('utf-8'))
 
+    @staticmethod
+    def _decode_entry(entry, ent, entity_pattern):
+        """Convert the XML of an entry to a dict, ent mapping entities."""
         entry_obj = dict(words=[], readings=[], translations=[])
 
-        position, length = entry
-
-        self.dictfile.seek(position)
-        entry = self.dictfile.read(length)
-        jmdict_entity = '|'.join(map(re.escape, ent)).encode('utf-8')
-        entry = re.sub(b'&('+jmdict_entity+b');', b'\\1', entry)
+        entry = entity_pattern.sub(b'\\1', entry)
         entry = ET.fromstring(entry)
 
         for k_ele in entry.iter('k_ele'):
@@ -349,25 +1435,28 @@ class JMdict_e(object):
 
         return entry_obj
 
-    def _parse(self):
+    @staticmethod
+    def compile(artifact):
         print('parsing JMdict_e...')
         start = time.time()
+        dictfile = MappedFile('data/JMdict_e')
+
+        temp_dictionary = dict()
+        entities = dict()
+        entry_pos = array('Q')
+        entry_len = array('I')
 
         inside_jmdict = False
         inside_entry = False
         entry_keys = []
         entry_start = 0
 
-        while True:
-            line = self.dictfile.readline()
-            if not line:
-                break
-
+        for position, line in dictfile.lines():
             if not inside_jmdict:
                 if line.startswith(b'<!ENTITY'):
                     line = line.decode('utf-8')
                     key, value = re.match('<!ENTITY (.*?) "(.*?)"', line).groups()
-                    self.entities[key] = value
+                    entities[key] = value
                 if line == b'<JMdict>\n':
                     inside_jmdict = True
                 continue
@@ -375,7 +1464,7 @@ class JMdict_e(object):
             if not inside_entry:
                 if line == b'<entry>\n':
                     inside_entry = True
-                    entry_start = self.dictfile.tell() - len(line)
+                    entry_start = position
                 continue
 
             if line[2:5] == b'eb>':
@@ -384,36 +1473,82 @@ class JMdict_e(object):
 
             if line == b'</entry>\n':
                 inside_entry = False
-                entry_position = (entry_start, self.dictfile.tell() - entry_start)
+                entry_id = len(entry_pos)
+                entry_pos.append(entry_start)
+                entry_len.append(position + len(line) - entry_start)
 
                 for k in entry_keys:
-                    if not self.temp_dictionary.get(k):
-                        self.temp_dictionary[k] = []
-                    self.temp_dictionary[k].append(entry_position)
+                    if not temp_dictionary.get(k):
+                        temp_dictionary[k] = []
+                    temp_dictionary[k].append(entry_id)
 
                 entry_keys = []
 
         print('    parsed in {:.2f} s'.format(time.time() - start))
 
+        print('compiling JMdict_e entries...')
+        start = time.time()
+
+        jmdict_entity = '|'.join(map(re.escape, entities)).encode('utf-8')
+        entity_pattern = re.compile(b'&('+jmdict_entity+b');')
+        records = bytearray()
+        record_offsets = array('Q', [0])
+        for position, length in zip(entry_pos, entry_len):
+            entry = JMdict_e._decode_entry(bytes(dictfile.read(position, length)),
+                entities, entity_pattern)
+            records += json.dumps(entry,
+                ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            record_offsets.append(len(records))
+
+        dictfile.close()
+        print('    compiled in {:.2f} s'.format(time.time() - start))
+
+        artifact.save(
+            [('entry_pos', entry_pos), ('entry_len', entry_len),
+                ('records', records), ('record_offsets', record_offsets)] +
+                Dictionary.pack(temp_dictionary),
+            dict(entities=entities))
+
 
 class Kanjidic2(object):
 
+    VERSION = 1
+    ARTIFACT = ('kanjidic2', VERSION, ['data/kanjidic2.xml'])
+
     def __init__(self):
-        self.dicfile = open('data/kanjidic2.xml', 'rb')
-        self.dic = dict()
-        self._parse()
+        self.index = Artifact.open(*Kanjidic2.ARTIFACT, compile=Kanjidic2.compile)
+        self.codepoints = self.index['codepoints']
+        self.frequencies = self.index['freq']
+        self.records = self.index['records']
+        self.record_offsets = self.index['record_offsets']
 
     def get(self, kanji):
-        dic_entry = self.dic.get(kanji)
-        if not dic_entry:
+        i = self._find(kanji)
+        if i is None:
             return
+        start, end = self.record_offsets[i], self.record_offsets[i + 1]
+        return json.loads(bytes(self.records[start:end]).decode('utf-8'))
 
-        entry = dict(literal=kanji, on=[], kun=[], nanori=[], meaning=[])
+    def freq(self, kanji):
+        """Frequency rank of kanji as returned by get(), or None."""
+        i = self._find(kanji)
+        if i is None:
+            return
+        return self.frequencies[i] or None
 
-        position, length = dic_entry
+    def _find(self, kanji):
+        if len(kanji) != 1:
+            return
+        code = ord(kanji)
+        i = bisect_left(self.codepoints, code)
+        if i == len(self.codepoints) or self.codepoints[i] != code:
+            return
+        return i
+
+    @staticmethod
+    def _decode(kanji, character):
+        entry = dict(literal=kanji, on=[], kun=[], nanori=[], meaning=[])
 
-        self.dicfile.seek(position)
-        character = self.dicfile.read(length)
         character = ET.fromstring(character)
 
         # stroke count, frequency
@@ -451,271 +1586,775 @@ class Kanjidic2(object):
 
         return entry
 
-    def _parse(self):
+    @staticmethod
+    def compile(artifact):
         print('parsing kanjidic2...')
         start = time.time()
+        dicfile = MappedFile('data/kanjidic2.xml')
+
+        characters = dict()
 
         inside_character = False
         literal = None
         character_start = 0
 
-        while True:
-            line = self.dicfile.readline()
-            if not line:
-                break
-
+        lines = dicfile.lines()
+        for position, line in lines:
             if not inside_character:
                 if line == b'<character>\n':
                     inside_character = True
-                    character_start = self.dicfile.tell() - len(line)
-                    literal = self.dicfile.readline()[9:-11].decode('utf-8')
+                    character_start = position
+                    literal = next(lines)[1][9:-11].decode('utf-8')
                 continue
 
             if line == b'</character>\n':
                 inside_character = False
-                character_position = (character_start, self.dicfile.tell() - character_start)
-                self.dic[literal] = character_position
+                character_position = (character_start,
+                    position + len(line) - character_start)
+                characters[literal] = character_position
 
         print('    parsed in {:.2f} s'.format(time.time() - start))
 
+        print('compiling kanjidic2 characters...')
+        start = time.time()
+
+        codepoints = array('I')
+        frequencies = array('H')
+        records = bytearray()
+        record_offsets = array('I', [0])
+        for literal in sorted(characters, key=ord):
+            position, length = characters[literal]
+            entry = Kanjidic2._decode(literal,
+                bytes(dicfile.read(position, length)))
+            codepoints.append(ord(literal))
+            frequencies.append((entry or dict()).get('freq') or 0)
+            records += json.dumps(entry, ensure_ascii=False,
+                separators=(',', ':')).encode('utf-8')
+            record_offsets.append(len(records))
+
+        dicfile.close()
+        print('    compiled in {:.2f} s'.format(time.time() - start))
+
+        artifact.save([('codepoints', codepoints), ('freq', frequencies),
+            ('records', records), ('record_offsets', record_offsets)])
+
+
+class Permutation(object):
+    """Seeded pseudorandom bijection over range(n).
+
+    A balanced Feistel network permutes the smallest power of four
+    covering n. Values outside range(n) are encrypted again until they
+    fall inside it (cycle walking), so any position of a shuffled
+    sequence is computed on its own, without materializing the rest.
+    """
+
+    ROUNDS = 4
+
+    def __init__(self, n, seed):
+        self.n = n
+        self.half = (max(1, (n - 1).bit_length()) + 1) // 2
+        self.mask = (1 << self.half) - 1
+        rng = random.Random(seed)
+        self.keys = [rng.getrandbits(32) for _ in range(Permutation.ROUNDS)]
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        while True:
+            i = self._encrypt(i)
+            if i < self.n:
+                return i
+
+    def _encrypt(self, x):
+        left, right = x >> self.half, x & self.mask
+        for key in self.keys:
+            left, right = right, left ^ (
+                ((right ^ key) * 0x9E3779B1 & 0xFFFFFFFF) >> (32 - self.half))
+        return left << self.half | right
+
 
 class Tatoeba(object):
 
-    def __init__(self):
-        self.datafile = open('data/wwwjdic.csv', 'rb')
-        self.dictionary = dict()
-        self.lines = []
-        self._parse()
+    VERSION = 4
+    ARTIFACT = ('tatoeba', VERSION, ['data/wwwjdic.csv'])
+    # examples kept for each headword and reading
+    EXAMPLES = 100
 
-    def search_phrase(self, phrase, max, start, shuffle):
-        lines = list(self.lines)
+    def __init__(self):
+        self.index = Artifact.open(*Tatoeba.ARTIFACT, compile=Tatoeba.compile)
+        # 'jpn\teng' of each line
+        self.sentences = StringTable(self.index['sentences'],
+            self.index['sentence_offsets'])
+        self.sentence_rank = self.index['sentence_rank']
+        # headword i has counts[i] examples, ranked for each of its readings
+        # r = group_reading[g] with g in groups[i]:groups[i + 1] as the
+        # slice example_*[group_offsets[g]:group_offsets[g + 1]] of
+        # parallel columns
+        self.headwords = Trie.from_artifact(self.index)
+        self.counts = self.index['counts']
+        self.groups = self.index['groups']
+        self.group_reading = self.index['group_reading']
+        self.group_offsets = self.index['group_offsets']
+        self.example_line = self.index['example_line']
+        self.example_sense = self.index['example_sense']
+        self.example_form = self.index['example_form']
+        # readings and forms, 0 being none
+        self.strings = StringTable(self.index['strings'], self.index['string_offsets'])
+        self.phrases = NgramIndex.from_artifact(self.index)
+
+    def search_phrase(self, phrase, max, start, shuffle, seed=None, position=0):
+        """Up to max examples containing phrase, skipping the first start.
+
+        Candidates are scanned from position, shuffled by the permutation
+        for seed (a random one if None). Also returns the position to
+        continue from with the same seed, or None once all are scanned.
+        """
+        grams = NgramIndex.grams(phrase)
+        if grams:
+            lines = self.phrases.search(grams)
+        else:
+            lines = range(len(self.sentences))
         if shuffle:
-            random.shuffle(lines)
+            order = Permutation(len(lines),
+                random.getrandbits(32) if seed is None else seed)
 
         examples = []
         counter = 0
-        while counter < start + max and lines:
-            file_pos, length = lines.pop(0)
-            self.datafile.seek(file_pos)
-            line = self.datafile.read(length).decode('utf-8')
-
-            jpn, eng = line.split('\t')[2:4]
-            if phrase in jpn:
+        while position < len(lines) and counter < start + max:
+            line = lines[order[position] if shuffle else position]
+            position += 1
+            example = self._entry(line)
+            # bigram hits only make the phrase likely, check the text
+            if phrase in example['jpn']:
                 if counter >= start:
-                    examples.append(dict(jpn=jpn, eng=eng))
+                    examples.append(example)
                 counter += 1
 
-        return examples
+        return examples, position if position < len(lines) else None
+
+    def get(self, headwords, readings, limit=None, offset=0):
+        """Ranked examples of the first headword having any.
 
-    def get(self, headwords, readings):
+        Examples annotated with a reading other than those given are left
+        out. Lists of several readings are merged by rank.
+        """
         for hw in headwords:
-            entries = self.dictionary.get(hw)
+            i = self._headword(hw)
             headword = hw
-            if entries:
+            if i is not None:
                 break
         else:
             return []
 
-        def matches(entry):
-            reading_matches = None
-            for reading in readings:
-                if entry[1]:
-                    if reading != entry[1]:
-                        reading_matches = False
-                    elif reading == entry[1]:
-                        reading_matches = True
-                        break
-            if reading_matches == False:
-                return False
-            return True
+        groups = range(self.groups[i], self.groups[i + 1])
+        if readings:
+            # the first group has the examples without a reading
+            groups = [g for g in groups if g == groups[0] or
+                self.strings[self.group_reading[g]] in readings]
+        if len(groups) == 1:
+            g = groups[0]
+            entries = range(self.group_offsets[g], self.group_offsets[g + 1])
+        else:
+            # examples without a reading are in every group
+            unique = dict()
+            for g in groups[::-1]:
+                for e in range(self.group_offsets[g], self.group_offsets[g + 1]):
+                    unique[self.example_line[e], self.example_sense[e],
+                        self.example_form[e]] = e
+            entries = sorted(unique.values(),
+                key=lambda e: self.sentence_rank[self.example_line[e]])
 
         return [
             dict(
-                self._entry(entry[0]),
-                sense=entry[2] or 0,
-                form=entry[3] or headword
+                self._entry(self.example_line[entry]),
+                sense=self.example_sense[entry],
+                form=self.strings[self.example_form[entry]] or headword
             )
-            for entry in filter(matches, entries)
+            for entry in entries[offset:offset + limit if limit else None]
         ]
 
-    def _entry(self, file_pos):
-        file_pos, length = file_pos
+    def count(self, headword):
+        i = self._headword(headword)
+        return 0 if i is None else self.counts[i]
 
-        self.datafile.seek(file_pos)
-        line = self.datafile.read(length).decode('utf-8')
+    def _headword(self, headword):
+        node, _ = self.headwords.walk(headword)
+        if node is None or not self.headwords.terminal[node]:
+            return None
+        return self.headwords.key_id(node)
 
-        jpn, eng = line.split('\t')[2:4]
+    def _entry(self, line):
+        jpn, eng = self.sentences[line].split('\t')
 
         return dict(jpn=jpn, eng=eng)
 
-    def _parse(self):
+    @staticmethod
+    def compile(artifact):
         print('parsing wwwjdic.csv...')
         start = time.time()
+        datafile = MappedFile('data/wwwjdic.csv')
+
+        dictionary = dict()
+        sentences = []
+        texts = []
 
         index_pattern = re.compile(r'([^\(\[\{~]+)(?:\|\d)?(\(.*?\))?(\[\d\d\])?({.*?})?(~)?')
 
-        while True:
-            line = self.datafile.readline()
-            if not line:
-                break
+        for _, line in datafile.lines():
+            line_id = len(sentences)
 
-            length = len(line)
-            file_pos = self.datafile.tell() - length
-            file_pos = (file_pos, length)
-            self.lines.append(file_pos)
+            jpn, eng = line.decode('utf-8').split('\t')[2:4]
+            sentences.append(jpn)
+            texts.append(jpn + '\t' + eng)
 
             indices = line[line.rfind(b'\t') + 1:].decode('utf-8').split()
 
             for index in indices:
                 headword, reading, sense, form, good = index_pattern.match(index).groups()
                 if good:
-                    if not self.dictionary.get(headword):
-                        self.dictionary[headword] = []
+                    if not dictionary.get(headword):
+                        dictionary[headword] = []
                     if reading:
                         reading = reading[1:-1]
                     if sense:
                         sense = int(sense[1:-1])
                     if form:
                         form = form[1:-1]
-                    self.dictionary[headword].append((file_pos, reading, sense, form))
+                    dictionary[headword].append((line_id, reading, sense, form))
 
+        datafile.close()
         print('    parsed in {:.2f} s'.format(time.time() - start))
 
+        print('indexing wwwjdic.csv phrases...')
+        start = time.time()
+        headwords = sorted(dictionary)
+        strings = ['']
+        string_ids = {'': 0}
+        def string_id(s):
+            if s not in string_ids:
+                string_ids[s] = len(strings)
+                strings.append(s)
+            return string_ids[s]
+
+        # shorter sentences are better examples
+        sentence_rank = array('I', [0]) * len(sentences)
+        for rank, line_id in enumerate(sorted(range(len(sentences)),
+                key=lambda l: len(sentences[l]))):
+            sentence_rank[line_id] = rank
+
+        counts = array('I')
+        groups = array('I', [0])
+        group_reading = array('I')
+        group_offsets = array('I', [0])
+        example_line = array('I')
+        example_sense = array('B')
+        example_form = array('I')
+        for headword in headwords:
+            entries = dictionary[headword]
+            counts.append(len(entries))
+            # examples without a reading go with every reading
+            for reading in [''] + sorted(set(e[1] for e in entries if e[1])):
+                ranked = sorted((e for e in entries if not e[1] or e[1] == reading),
+                    key=lambda e: sentence_rank[e[0]])
+                for line_id, _, sense, form in ranked[:Tatoeba.EXAMPLES]:
+                    example_line.append(line_id)
+                    example_sense.append(sense or 0)
+                    example_form.append(string_id(form or ''))
+                group_reading.append(string_id(reading))
+                group_offsets.append(len(example_line))
+            groups.append(len(group_reading))
+        strings, string_offsets = StringTable.pack(strings)
+        texts, text_offsets = StringTable.pack(texts)
+
+        artifact.save([('sentences', texts), ('sentence_offsets', text_offsets),
+            ('sentence_rank', sentence_rank), ('counts', counts),
+            ('groups', groups), ('group_reading', group_reading),
+            ('group_offsets', group_offsets), ('example_line', example_line),
+            ('example_sense', example_sense), ('example_form', example_form),
+            ('strings', strings), ('string_offsets', string_offsets)] +
+            Trie.pack(headwords) + NgramIndex.pack(sentences, unigrams=True))
+        print('    indexed in {:.2f} s'.format(time.time() - start))
+
 
 class KanjiVGParts(object):
 
-    CACHE = 'data/cache/kanjivgparts.pickle'
+    VERSION = 1
+    KANJIVG = 'client/kanji'
+    NS = {
+        'svg': 'http://www.w3.org/2000/svg',
+        'kvg': 'http://kanjivg.tagaini.net'
+    }
+    ARTIFACT = ('kanjivgparts', VERSION, [KANJIVG])
 
     def __init__(self):
-        if isfile(KanjiVGParts.CACHE):
-            print('loading KanjiVG parts from cache...')
-            start = time.time()
-            with open(KanjiVGParts.CACHE, 'rb') as f:
-                self.kanji = pickle.load(f)
-            print('    loaded in {:.2f} s'.format(time.time() - start))
-        else:
-            self.kanji = dict()
-            self._parse()
-            with open(KanjiVGParts.CACHE, 'wb') as f:
-                pickle.dump(self.kanji, f, pickle.HIGHEST_PROTOCOL)
+        self.index = Artifact.open(*KanjiVGParts.ARTIFACT,
+            compile=KanjiVGParts.compile)
+        # one line per kanji: the kanji, a tab and its parts separated by spaces
+        self.kanji = dict()
+        for line in bytes(self.index['parts']).decode('utf-8').splitlines():
+            char, parts = line.split('\t')
+            self.kanji[char] = set(parts.split(' ')) if parts else set()
+        self._index()
 
     def get_parts(self, kanji):
         return list(self.kanji.get(kanji) or [])
 
-    def get_combinations(self, parts):
-        combinations = []
-
-        for k in self.kanji:
-            if parts.issubset(self.kanji[k]):
-                combinations.append(k)
-
-        combinations = list(map(
-            lambda k: (k, (kanjidic2.get(k) or dict()).get('freq') or 2501),
-            combinations))
-
-        combinations.sort(key=lambda k: k[1])
+    def get_combinations(self, parts, limit=None, offset=0):
+        # intersect from the rarest part, bit i standing for self.ranked[i]
+        postings = sorted((self.components.get(p, 0) for p in parts),
+            key=lambda b: bin(b).count('1'))
+        if not postings:
+            return []
+        bits = postings[0]
+        for b in postings[1:]:
+            if not bits:
+                break
+            bits &= b
 
-        return combinations
+        combinations = []
+        while bits and (limit is None or len(combinations) < offset + limit):
+            lowest = bits & -bits
+            combinations.append(self.ranked[lowest.bit_length() - 1])
+            bits ^= lowest
+
+        return combinations[offset:]
+
+    def _index(self):
+        """Rank kanji by frequency and map each component to a bitset of ranks."""
+        ranked = [(k, kanjidic2.freq(k) or 2501) for k in self.kanji]
+        ranked.sort(key=lambda k: k[1])
+        components = dict()
+        for rank, (k, _) in enumerate(ranked):
+            for part in self.kanji[k]:
+                components[part] = components.get(part, 0) | 1 << rank
+        self.ranked = ranked
+        self.components = components
 
-    def _parse(self):
+    @staticmethod
+    def compile(artifact):
         print('parsing KanjiVG parts...')
         start = time.time()
 
-        KANJIVG = 'client/kanji'
-        NS = {
-            'svg': 'http://www.w3.org/2000/svg',
-            'kvg': 'http://kanjivg.tagaini.net'
-        }
+        files = [os.path.join(KanjiVGParts.KANJIVG, f)
+            for f in sorted(os.listdir(KanjiVGParts.KANJIVG))]
+        with ProcessPoolExecutor() as executor:
+            info = list(executor.map(KanjiVGParts._get_info, files,
+                chunksize=256))
 
-        def get_parts(group):
-            parts = []
-            for g in group.findall('svg:g', NS):
-                element = g.attrib.get('{'+NS['kvg']+'}element')
-                if element:
-                    parts.append(element)
-                else:
-                    parts += get_parts(g)
-            return parts
-
-        def get_info(f):
-            kanji = ET.parse(f).getroot().find('svg:g', NS).find('svg:g', NS)
-            char = kanji.attrib.get('{'+NS['kvg']+'}element')
-            parts = get_parts(kanji)
-            return char, parts
-
-        for f in os.listdir(KANJIVG):
-            char, parts = get_info(os.path.join(KANJIVG, f))
+        kanji = dict()
+        for char, parts in info:
             if char:
-                self.kanji[char] = set(parts)
+                kanji[char] = parts
+        artifact.save([('parts', '\n'.join(
+            '{}\t{}'.format(char, ' '.join(sorted(set(parts))))
+            for char, parts in kanji.items()).encode('utf-8'))])
 
         print('    parsed in {:.2f} s'.format(time.time() - start))
 
+    @staticmethod
+    def _get_parts(group):
+        NS = KanjiVGParts.NS
+        parts = []
+        for g in group.findall('svg:g', NS):
+            element = g.attrib.get('{'+NS['kvg']+'}element')
+            if element:
+                parts.append(element)
+            else:
+                parts += KanjiVGParts._get_parts(g)
+        return parts
+
+    @staticmethod
+    def _get_info(f):
+        NS = KanjiVGParts.NS
+        kanji = ET.parse(f).getroot().find('svg:g', NS).find('svg:g', NS)
+        char = kanji.attrib.get('{'+NS['kvg']+'}element')
+        parts = KanjiVGParts._get_parts(kanji)
+        return char, parts
+
 
 class KanjiSimilars(object):
 
+    VERSION = 1
+    FILE = 'data/kanji.tgz_similars.ut8'
+    ARTIFACT = ('kanjisimilars', VERSION, [FILE])
+
     def __init__(self):
-        self.file = 'data/kanji.tgz_similars.ut8'
-        self._parse()
+        self.index = Artifact.open(*KanjiSimilars.ARTIFACT,
+            compile=KanjiSimilars.compile)
+        self.similars = json.loads(bytes(self.index['similars']).decode('utf-8'))
 
     def get(self, kanji):
         similar = list(map(
-            lambda k: (k, (kanjidic2.get(k) or dict()).get('freq') or 2501),
+            lambda k: (k, kanjidic2.freq(k) or 2501),
             self.similars.get(kanji) or []))
         similar.sort(key=lambda k: k[1])
         return similar
 
-    def _parse(self):
+    @staticmethod
+    def compile(artifact):
         print('parsing kanji.tgz_similars.ut8...')
         start = time.time()
 
-        self.similars = dict()
-        with open(self.file, 'rb') as f:
+        similars = dict()
+        with open(KanjiSimilars.FILE, 'rb') as f:
             lines = f.read().decode('utf-8').splitlines()
         for l in lines:
             l = [k for k in l.split('/') if k.strip()]
-            self.similars[l[0]] = l[1:]
+            similars[l[0]] = l[1:]
+        artifact.save([('similars', json.dumps(similars,
+            ensure_ascii=False).encode('utf-8'))])
 
         print('    parsed in {:.2f} s'.format(time.time() - start))
 
 
-class MecabHandler(web.RequestHandler):
+class Loader(object):
+    """Construct data sources in background threads.
+
+    Each source is published as a module global of the same name once it
+    is loaded, so the server can listen while the dictionaries load.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.futures = OrderedDict()
+        self.times = dict()
+        self.ready_time = None
+        self.lock = Lock()
+
+    def load(self, name, factory, requires=()):
+        """Run factory() in a thread once the required sources are loaded."""
+        future = self.futures[name] = Future()
 
+        def run():
+            try:
+                for r in requires:
+                    self.futures[r].result()
+                start = time.time()
+                source = factory()
+            except Exception as e:
+                print('failed to load {}: {!r}'.format(name, e))
+                future.set_exception(e)
+                return
+            self.times[name] = time.time() - start
+            globals()[name] = source
+            future.set_result(source)
+            with self.lock:
+                if self.ready_time is None and self.ready():
+                    self.ready_time = time.time() - self.start
+                    print('done! ready in {:.2f} s'.format(self.ready_time))
+
+        Thread(target=run, daemon=True).start()
+        return future
+
+    def ready(self, names=None):
+        futures = [self.futures[n] for n in names] if names else self.futures.values()
+        return all(f.done() and not f.exception() for f in futures)
+
+    def status(self):
+        status = dict()
+        for name, future in self.futures.items():
+            if not future.done():
+                status[name] = 'loading'
+            elif future.exception():
+                status[name] = 'failed: {!r}'.format(future.exception())
+            else:
+                status[name] = 'ready'
+        return status
+
+
+def call_source(name, method, *args):
+    """Call a method of a loaded source, in this or an executor process."""
+    return getattr(globals()[name], method)(*args)
+
+
+def lookup_batch(tokens, limit=None):
+    """Dictionary entries, kanji and example counts for analyzed tokens.
+
+    tokens is the /mecab output, either lines of token dicts or columns.
+    Every distinct word and kanji is looked up once and every entry is
+    decoded once, with words referring to entries by id.
+    """
+    if isinstance(tokens, dict):
+        fields = tokens['fields']
+        tokens = [[dict(zip(fields, values)) for values in zip(*line)]
+            for line in tokens['lines']]
+    if tokens and isinstance(tokens[0], list):
+        tokens = [t for line in tokens for t in line]
+
+    # the headword the client looks a token up by
+    keys = [(t.get('lemma') or '').split('-')[0] or t.get('literal') or ''
+        for t in tokens]
+    words, entries = jmdict_e.get_batch(keys, limit)
+    for word, result in words.items():
+        result['examples'] = tatoeba.count(word)
+    kanji = dict()
+    for c in set(''.join(keys) + ''.join(t.get('literal') or '' for t in tokens)):
+        info = kanjidic2.get(c)
+        if info is not None:
+            kanji[c] = info
+    return dict(tokens=keys, words=words, entries=entries, kanji=kanji)
+
+
+def _load_worker_sources():
+    # process executor initializer: map the artifacts the lookups use
+    Artifact.artifacts_only = True
+    for name, source in (('jmdict_e', JMdict_e), ('kanjidic2', Kanjidic2),
+            ('tatoeba', Tatoeba), ('kvgparts', KanjiVGParts)):
+        globals()[name] = source()
+
+
+class Dispatcher(object):
+    """Bounded executor for blocking lookups, shared by the handlers.
+
+    Every endpoint has its own concurrency limit, and the executor has as
+    many workers as all limits together, so requests only ever queue
+    behind requests to the same endpoint.
+    """
+
+    # default limits, overridden by <endpoint>_concurrency in the config
+    LIMITS = OrderedDict([
+        ('analyze', 4),
+        ('lookup_batch', 2),
+        ('jmdict_e', 4),
+        ('regex', 2),
+        ('tatoeba', 4),
+        ('phrase', 2),
+        ('kvgcombinations', 2),
+    ])
+
+    def __init__(self):
+        self.limits = OrderedDict((endpoint, int(
+                Config.get(endpoint + '_concurrency') or limit))
+            for endpoint, limit in Dispatcher.LIMITS.items())
+        workers = sum(self.limits.values())
+        self.kind = Config.get('lookup_executor') or 'thread'
+        if self.kind == 'process':
+            # spawned, not forked: the server has threads and open pipes
+            self.executor = ProcessPoolExecutor(workers,
+                mp_context=get_context('spawn'),
+                initializer=_load_worker_sources)
+        else:
+            self.kind = 'thread'
+            self.executor = ThreadPoolExecutor(workers)
+        self.semaphores = dict((endpoint, locks.Semaphore(limit))
+            for endpoint, limit in self.limits.items())
+        self.stats = dict((endpoint, dict(limit=limit, running=0, queued=0,
+                max_queued=0, completed=0, wait_time=0.0, run_time=0.0))
+            for endpoint, limit in self.limits.items())
+
+    @gen.coroutine
+    def run(self, endpoint, fn, *args):
+        """Call fn(*args) in the executor, queueing at the endpoint's limit."""
+        stats = self.stats[endpoint]
+        queued = time.time()
+        stats['queued'] += 1
+        stats['max_queued'] = max(stats['max_queued'], stats['queued'])
+        with (yield self.semaphores[endpoint].acquire()):
+            stats['queued'] -= 1
+            stats['running'] += 1
+            start = time.time()
+            stats['wait_time'] += start - queued
+            metrics.observe('executor_wait_seconds', start - queued,
+                endpoint=endpoint)
+            if self.kind == 'thread':
+                fn, args = profiler.call, (fn,) + args
+            try:
+                result = yield self.executor.submit(fn, *args)
+            finally:
+                stats['running'] -= 1
+                stats['completed'] += 1
+                stats['run_time'] += time.time() - start
+        return result
+
+
+class SourceHandler(web.RequestHandler):
+    """Handler answering 503 until the sources it uses are loaded."""
+
+    SOURCES = ()
+
+    @gen.coroutine
+    def write_cached(self, args, compute, cacheable=None):
+        """Write the JSON of compute() through the response cache.
+
+        Responses are keyed by path, args (the hashable arguments compute
+        uses, as parsed by the handler) and the digests of the sources'
+        artifacts, and answered with 304 if the client has the same ETag.
+        compute may return a future; results failing cacheable are not kept.
+        """
+        version = tuple(globals()[name].index.digest for name in self.SOURCES)
+        key = (self.request.path, args, version)
+        entry = response_cache.get(key)
+        if entry is None:
+            response = compute()
+            if is_future(response):
+                response = yield response
+            body = json.dumps(response).encode('utf-8')
+            if cacheable is not None and not cacheable(response):
+                self.write(body)
+                return
+            entry = response_cache.put(key, body)
+        etag, body, compressed = entry
+        gzipped = compressed and 'gzip' in self.request.headers.get('Accept-Encoding', '')
+        # the gzip and identity bodies are different representations
+        self.set_header('Etag', etag[:-1] + '-gzip"' if gzipped else etag)
+        if self.check_etag_header():
+            response_cache.not_modified += 1
+            response_cache.bytes_saved += len(compressed if gzipped else body)
+            self.set_status(304)
+            return
+        if gzipped:
+            response_cache.bytes_saved += len(body) - len(compressed)
+            self.set_header('Content-Encoding', 'gzip')
+            body = compressed
+        self.write(body)
+
+    def prepare(self):
+        if not loader.ready(self.SOURCES):
+            sources = dict((n, s) for n, s in loader.status().items()
+                if n in self.SOURCES)
+            failed = any(s.startswith('failed') for s in sources.values())
+            self.set_status(503)
+            if not failed:
+                self.set_header('Retry-After', '1')
+            self.set_header('Content-Type', 'application/json')
+            self.finish(json.dumps(dict(
+                error='failed' if failed else 'loading', sources=sources)))
+
+
+class HealthHandler(web.RequestHandler):
+
+    def get(self):
+        self.set_header('Cache-Control', 'max-age=0')
+        self.set_header('Content-Type', 'application/json')
+        ready = loader.ready()
+        if not ready:
+            self.set_status(503)
+        self.write(json.dumps(dict(
+            ready=ready,
+            sources=loader.status(),
+            load_times=loader.times,
+            uptime=time.time() - loader.start,
+            time_to_ready=loader.ready_time,
+        )))
+
+
+class MecabHandler(SourceHandler):
+
+    SOURCES = ('mecab',)
+
+    @gen.coroutine
+    def post(self):
+        data = json.loads(self.request.body.decode('utf-8')).strip()
+        stream = self.get_query_argument('stream', default='no') == 'yes'
+        # columns: field names once, then per line one value list per field
+        columns = self.get_query_argument('format', default='dict') == 'columns'
+        encode = mecab.Token.columns if columns else (
+            lambda tokens: [t.to_dict() for t in tokens])
+        dumps = json.dumps
+        if columns:
+            dumps = lambda o: json.dumps(o, ensure_ascii=False)
+        futures = mecab.analyze_batch(data.splitlines())
+        # yielded one by one: IOLoop.add_future is safe for thread futures
+        if stream:
+            # one JSON document per input line, flushed as soon as it is ready
+            self.set_header('Content-Type', 'application/x-ndjson')
+            if columns:
+                self.write(dumps(dict(fields=mecab.Token.FIELDS)) + '\n')
+            for future in futures:
+                self.write(dumps(encode((yield future))) + '\n')
+                yield self.flush()
+            return
+        result = []
+        for future in futures:
+            result.append(encode((yield future)))
+        if columns:
+            result = dict(fields=mecab.Token.FIELDS, lines=result)
+        self.write(dumps(result))
+
+
+class AnalyzeHandler(SourceHandler):
+
+    SOURCES = ('mecab', 'jmdict_e')
+
+    @gen.coroutine
     def post(self):
         data = json.loads(self.request.body.decode('utf-8')).strip()
-        self.write(json.dumps([mecab.analyze(line) for line in data.splitlines()]))
+        # one JSON list of annotated tokens per input line
+        self.set_header('Content-Type', 'application/x-ndjson')
+        futures = mecab.analyze_batch(data.splitlines())
+        # yielded one by one: IOLoop.add_future is safe for thread futures
+        for future in futures:
+            tokens = [t.to_dict() for t in (yield future)]
+            tokens = yield dispatcher.run('analyze',
+                call_source, 'jmdict_e', 'annotate', tokens)
+            self.write(json.dumps(tokens) + '\n')
+            yield self.flush()
+
 
+class JMdict_eHandler(SourceHandler):
 
-class JMdict_eHandler(web.RequestHandler):
+    SOURCES = ('jmdict_e',)
 
+    @gen.coroutine
     def get(self):
         self.set_header('Cache-Control', 'max-age=3600')
         self.set_header('Content-Type', 'application/json')
         query = self.get_query_argument('query').strip()
         regex = True if self.get_query_argument('regex', default='no') == 'yes' else False
-        response = jmdict_e.get(query, regex)
-        self.write(json.dumps(response))
+        limit = self.get_query_argument('limit', default=None)
+        limit = int(limit) if limit else None
+        if regex:
+            offset = int(self.get_query_argument('offset', default=0))
+            try:
+                Dictionary.compile_regex(query)
+            except (re.error, ValueError) as e:
+                raise web.HTTPError(400, 'invalid pattern {!r}: {}'.format(query, e))
+            # partial results of a timed out pattern are not cached
+            yield self.write_cached((query, regex, limit, offset),
+                lambda: dispatcher.run('regex',
+                    call_source, 'jmdict_e', 'get', query, regex, limit, offset),
+                lambda response: not response.get('regex_timeout'))
+        else:
+            yield self.write_cached((query, regex, limit),
+                lambda: dispatcher.run('jmdict_e',
+                    call_source, 'jmdict_e', 'get', query, regex, limit))
+
 
+class Kanjidic2Handler(SourceHandler):
 
-class Kanjidic2Handler(web.RequestHandler):
+    SOURCES = ('kanjidic2',)
 
+    @gen.coroutine
     def get(self):
         self.set_header('Cache-Control', 'max-age=3600')
         self.set_header('Content-Type', 'application/json')
         query = self.get_query_argument('query').strip()
-        self.write(json.dumps(kanjidic2.get(query)))
+        yield self.write_cached(query, lambda: kanjidic2.get(query))
 
 
-class TatoebaHandler(web.RequestHandler):
+class TatoebaHandler(SourceHandler):
 
+    SOURCES = ('tatoeba',)
+
+    @gen.coroutine
     def get(self):
         self.set_header('Cache-Control', 'max-age=3600')
         self.set_header('Content-Type', 'application/json')
         query = self.get_query_argument('query').strip().split(',')
         readings = self.get_query_argument('readings', default='').split(',')
-        self.write(json.dumps(tatoeba.get(query, readings)))
+        limit = self.get_query_argument('limit', default=None)
+        limit = int(limit) if limit else None
+        offset = int(self.get_query_argument('offset', default=0))
+        yield self.write_cached((tuple(query), tuple(readings), limit, offset),
+            lambda: dispatcher.run('tatoeba',
+                call_source, 'tatoeba', 'get', query, readings, limit, offset))
+
+class PhraseHandler(SourceHandler):
 
-class PhraseHandler(web.RequestHandler):
+    SOURCES = ('tatoeba',)
 
+    @gen.coroutine
     def get(self):
         self.set_header('Cache-Control', 'max-age=0')
         self.set_header('Content-Type', 'application/json')
@@ -724,33 +2363,164 @@ class PhraseHandler(web.RequestHandler):
         start = int(self.get_query_argument('start', default=0))
         shuffle = True if self.get_query_argument(
             'shuffle', default='yes') == 'yes' else False
-        self.write(json.dumps(tatoeba.search_phrase(query, max, start, shuffle)))
+        cursor = self.get_query_argument('cursor', default=None)
+        if cursor is None:
+            examples, _ = yield dispatcher.run('phrase', call_source,
+                'tatoeba', 'search_phrase', query, max, start, shuffle)
+            self.write(json.dumps(examples))
+            return
+
+        # an empty cursor starts a new sequence, see Tatoeba.search_phrase
+        try:
+            seed, position = map(int, cursor.split('.')) if cursor else (
+                random.getrandbits(32), 0)
+        except ValueError:
+            position = -1
+        if position < 0:
+            raise web.HTTPError(400, 'invalid cursor')
+        examples, position = yield dispatcher.run('phrase', call_source,
+            'tatoeba', 'search_phrase', query, max, start, shuffle, seed, position)
+        self.write(json.dumps(dict(examples=examples, cursor=None
+            if position is None else '{}.{}'.format(seed, position))))
+
+class LookupBatchHandler(SourceHandler):
+
+    SOURCES = ('jmdict_e', 'kanjidic2', 'tatoeba')
 
-class KanjiVGPartsHandler(web.RequestHandler):
+    @gen.coroutine
+    def post(self):
+        self.set_header('Content-Type', 'application/json')
+        tokens = json.loads(self.request.body.decode('utf-8'))
+        limit = self.get_query_argument('limit', default='10')
+        limit = int(limit) if limit else None
+        self.write(json.dumps((yield dispatcher.run('lookup_batch',
+            lookup_batch, tokens, limit))))
+
+
+class KanjiVGPartsHandler(SourceHandler):
 
+    SOURCES = ('kvgparts',)
+
+    @gen.coroutine
     def get(self):
         self.set_header('Cache-Control', 'max-age=3600')
         self.set_header('Content-Type', 'application/json')
         query = self.get_query_argument('query').strip()
-        self.write(json.dumps(kvgparts.get_parts(query)))
+        yield self.write_cached(query, lambda: kvgparts.get_parts(query))
+
 
+class KanjiVGCombinationsHandler(SourceHandler):
 
-class KanjiVGCombinationsHandler(web.RequestHandler):
+    SOURCES = ('kvgparts',)
 
+    @gen.coroutine
     def get(self):
         self.set_header('Cache-Control', 'max-age=3600')
         self.set_header('Content-Type', 'application/json')
         query = self.get_query_argument('query').strip().split(',')
-        self.write(json.dumps(kvgparts.get_combinations(set(query))))
+        limit = self.get_query_argument('limit', default=None)
+        limit = int(limit) if limit else None
+        offset = int(self.get_query_argument('offset', default=0))
+        yield self.write_cached((frozenset(query), limit, offset),
+            lambda: dispatcher.run('kvgcombinations',
+                call_source, 'kvgparts', 'get_combinations', set(query),
+                limit, offset))
 
 
-class KanjiSimilarsHandler(web.RequestHandler):
+class KanjiSimilarsHandler(SourceHandler):
 
+    SOURCES = ('kanjidic2', 'kanjisimilars')
+
+    @gen.coroutine
     def get(self):
         self.set_header('Cache-Control', 'max-age=3600')
         self.set_header('Content-Type', 'application/json')
         query = self.get_query_argument('query').strip()
-        self.write(json.dumps(kanjisimilars.get(query)))
+        yield self.write_cached(query, lambda: kanjisimilars.get(query))
+
+
+class StatsHandler(SourceHandler):
+
+    SOURCES = ('mecab', 'jmdict_e')
+
+    def get(self):
+        self.set_header('Cache-Control', 'max-age=0')
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(dict(
+            mecab_cache=mecab.cache.stats(),
+            analyze_cache=jmdict_e.resolved.stats(),
+            response_cache=response_cache.stats(),
+            executor=dispatcher.kind,
+            endpoints=dispatcher.stats,
+        )))
+
+
+class MetricsHandler(web.RequestHandler):
+
+    def get(self):
+        self.set_header('Cache-Control', 'max-age=0')
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        gauges = [('source_ready', dict(source=name), int(loader.ready([name])))
+            for name in loader.futures]
+        gauges += [('source_load_seconds', dict(source=name), seconds)
+            for name, seconds in loader.times.items()]
+        if loader.ready_time is not None:
+            gauges.append(('time_to_ready_seconds', dict(), loader.ready_time))
+        caches = [('response', response_cache.cache)]
+        if loader.ready(['mecab']):
+            gauges.append(('mecab_queue_depth', dict(),
+                sum(w.load() for w in mecab.workers)))
+            caches.append(('mecab', mecab.cache))
+        if loader.ready(['jmdict_e']):
+            caches.append(('analyze', jmdict_e.resolved))
+        counters = []
+        for name, cache in caches:
+            stats = cache.stats()
+            lookups = stats['hits'] + stats['misses']
+            counters += [
+                ('cache_hits_total', dict(cache=name), stats['hits']),
+                ('cache_misses_total', dict(cache=name), stats['misses']),
+            ]
+            gauges += [
+                ('cache_hit_ratio', dict(cache=name),
+                    stats['hits'] / lookups if lookups else 0),
+                ('cache_entries', dict(cache=name), stats['entries']),
+            ]
+            # the analyze cache counts entries, not bytes
+            if name != 'analyze':
+                gauges.append(('cache_size_bytes', dict(cache=name), stats['size']))
+        for endpoint, stats in dispatcher.stats.items():
+            gauges += [
+                ('executor_queued', dict(endpoint=endpoint), stats['queued']),
+                ('executor_running', dict(endpoint=endpoint), stats['running']),
+            ]
+        self.write(metrics.render(gauges, counters))
+
+
+class ProfileHandler(web.RequestHandler):
+    """cProfile the server for ?seconds=, if enabled with profiler=yes."""
+
+    @gen.coroutine
+    def get(self):
+        if (Config.get('profiler') != 'yes' or
+                self.request.remote_ip not in ('127.0.0.1', '::1')):
+            raise web.HTTPError(403)
+        if profiler.active:
+            raise web.HTTPError(409, 'a profile is already running')
+        seconds = min(float(self.get_query_argument('seconds', default=10)), 300)
+        limit = int(self.get_query_argument('limit', default=50))
+        sort = self.get_query_argument('sort', default='cumulative')
+        profiler.start()
+        try:
+            yield gen.sleep(seconds)
+        finally:
+            stats = profiler.stop()
+        # the full profile, for pstats or snakeviz
+        path = os.path.join(Artifact.DIRECTORY, 'profile.prof')
+        stats.dump_stats(path)
+        stats.sort_stats(sort).print_stats(limit)
+        self.set_header('Content-Type', 'text/plain')
+        self.write('saved to {}\n\n'.format(path) + stats.stream.getvalue())
 
 
 class TTSHandler(web.RequestHandler):
@@ -778,6 +2548,16 @@ class TTSEventHandler(websocket.WebSocketHandler):
             tts.clients.remove(self)
 
 
+class Application(web.Application):
+
+    def log_request(self, handler):
+        name = type(handler).__name__
+        metrics.inc('http_requests_total', handler=name, code=handler.get_status())
+        metrics.observe('http_request_duration_seconds',
+            handler.request.request_time(), handler=name)
+        super(Application, self).log_request(handler)
+
+
 class StaticFileHandler(web.StaticFileHandler):
 
     def get_content_type(self):
@@ -793,33 +2573,126 @@ class StaticFileHandler(web.StaticFileHandler):
 
 def get_app():
 
-    return web.Application([
+    return Application([
         (r'/mecab', MecabHandler),
+        (r'/analyze', AnalyzeHandler),
         (r'/jmdict_e', JMdict_eHandler),
         (r'/kanjidic2', Kanjidic2Handler),
         (r'/tatoeba', TatoebaHandler),
         (r'/phrase', PhraseHandler),
+        (r'/lookup_batch', LookupBatchHandler),
         (r'/kvgparts', KanjiVGPartsHandler),
         (r'/kvgcombinations', KanjiVGCombinationsHandler),
         (r'/kanjisimilars', KanjiSimilarsHandler),
         (r'/tts', TTSHandler),
         (r'/tts_events', TTSEventHandler),
+        (r'/stats', StatsHandler),
+        (r'/health', HealthHandler),
+        (r'/metrics', MetricsHandler),
+        (r'/admin/profile', ProfileHandler),
         (r'/(.*)', StaticFileHandler,
             {'path': 'client', 'default_filename': 'index.html'}),
-    ])
+    ], compress_response=True)
+
+
+# data sources with an artifact under data/cache, independent of each other
+SOURCES = [JMdict_e, Kanjidic2, Tatoeba, KanjiVGParts, KanjiSimilars]
+
+
+def build_index(source, force=False):
+    """Compile the artifact of source unless it is fresh and intact."""
+    artifact = Artifact(*source.ARTIFACT)
+    start = time.time()
+    built = force or not artifact.load() or not artifact.verify()
+    if built:
+        source.compile(artifact)
+        artifact.load()
+    verified = not built or artifact.verify()
+    artifact.close()
+    return dict(source=source.__name__, built=built, verified=verified,
+        time=time.time() - start, size=os.path.getsize(artifact.path))
+
+
+def build_indexes(force=False):
+    """Compile every source in its own process and report on each."""
+    start = time.time()
+    with ProcessPoolExecutor(len(SOURCES)) as executor:
+        reports = list(executor.map(build_index, SOURCES, [force] * len(SOURCES)))
+    print('{:14} {:>8} {:>10} {:>10}'.format('source', 'status', 'time', 'size'))
+    for r in reports:
+        status = ('built' if r['built'] else 'fresh') if r['verified'] else 'CORRUPT'
+        print('{:14} {:>8} {:8.2f} s {:7.1f} MB'.format(
+            r['source'], status, r['time'], r['size'] / 1e6))
+    print('built indexes in {:.2f} s'.format(time.time() - start))
+    return all(r['verified'] for r in reports)
+
+
+def check_artifacts():
+    """Report every artifact that is missing, stale or corrupt."""
+    ok = True
+    for source in SOURCES:
+        artifact = Artifact(*source.ARTIFACT)
+        if not artifact.load():
+            print('{} is missing or stale, run ./server.py --build-indexes'.format(
+                artifact.path))
+            ok = False
+        elif not artifact.verify():
+            print('{} is corrupt, run ./server.py --build-indexes'.format(
+                artifact.path))
+            ok = False
+        artifact.close()
+    return ok
+
+
+def load_sources():
+    """Start loading every source in the background, returning a Loader."""
+    loader = Loader()
+    builds = dict()
+    stale = []
+    if not Artifact.artifacts_only:
+        for source in SOURCES:
+            artifact = Artifact(*source.ARTIFACT)
+            if not artifact.load():
+                stale.append(source)
+            artifact.close()
+    if stale:
+        # compiled in parallel across processes, forked before the mecab
+        # workers start so that they do not inherit their pipes and stall Popen
+        executor = ProcessPoolExecutor(len(stale))
+        for source in stale:
+            builds[source] = executor.submit(build_index, source, True)
+        executor.shutdown(wait=False)
+    loader.load('mecab', Mecab)
+
+    def factory(source):
+        def load():
+            if source in builds:
+                builds[source].result()
+            return source()
+        return load
+
+    loader.load('jmdict_e', factory(JMdict_e))
+    loader.load('kanjidic2', factory(Kanjidic2))
+    loader.load('tatoeba', factory(Tatoeba))
+    loader.load('kvgparts', factory(KanjiVGParts), requires=['kanjidic2'])
+    loader.load('kanjisimilars', factory(KanjiSimilars))
+    return loader
 
 
 if __name__ == '__main__':
-    mecab = Mecab()
-    jmdict_e = JMdict_e()
-    kanjidic2 = Kanjidic2()
-    tatoeba = Tatoeba()
-    kvgparts = KanjiVGParts()
-    kanjisimilars = KanjiSimilars()
+    if '--build-indexes' in sys.argv:
+        sys.exit(0 if build_indexes('--force' in sys.argv) else 1)
+    if '--artifacts-only' in sys.argv or Config.get('artifacts_only') == 'yes':
+        Artifact.artifacts_only = True
+        if not check_artifacts():
+            sys.exit(1)
+    loader = load_sources()
     tts = TTS()
+    dispatcher = Dispatcher()
+    response_cache = ResponseCache(
+        int(float(Config.get('response_cache_size') or 32) * 1e6))
     app = get_app()
     app.listen(9874)
     main_loop = ioloop.IOLoop.instance()
-    print('done!')
     print('server listening to *:9874')
     main_loop.start()